@@ -0,0 +1,35 @@
+"""
+@brief - shared setup for the tests. The modules in wall_paper_switcher/
+         import each other by name, the same way they do when main.py is
+         run from its folder, so that folder is put on the import path.
+"""
+
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wall_paper_switcher"))
+
+
+class ListLogger():
+    """
+            Stands in for ErrorLogger, keeping what was logged in memory.
+
+            Class Members:
+                lines : list - (message, level) for each call to log, in order
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def log(self, message : str, level : str = None):
+        self.lines.append((message, level))
+
+    def time_str(self) -> str:
+        return "now"
+
+
+@pytest.fixture
+def logger():
+    return ListLogger()
@@ -0,0 +1,50 @@
+import backends
+from backends import FakeBackend, SubprocessBackend, create_backend
+
+
+def test_fake_backend_records_calls_in_order():
+    backend = FakeBackend()
+    backend.set_picture_options("zoom")
+    backend.set_picture_uri("picture-uri", "/tmp/a.jpg")
+    backend.set_monitor_images(("/tmp/a.jpg", "/tmp/b.jpg"), "/tmp/joined.jpg")
+    backend.set_spanned_image("/tmp/joined.jpg")
+
+    assert backend.calls == [
+        ("set_picture_options", ("zoom",)),
+        ("set_picture_uri", ("picture-uri", "/tmp/a.jpg")),
+        ("set_monitor_images", (["/tmp/a.jpg", "/tmp/b.jpg"], "/tmp/joined.jpg")),
+        ("set_spanned_image", ("/tmp/joined.jpg",)),
+    ]
+
+
+def test_create_backend_fake(logger):
+    backend = create_backend("fake", logger)
+    assert isinstance(backend, FakeBackend)
+    assert backend.name == "fake"
+    assert backend.calls == []
+
+
+class NoSchemas():
+    """ Stands in for Gio with no schemas installed"""
+
+    class SettingsSchemaSource():
+        @staticmethod
+        def get_default():
+            return None
+
+
+def test_auto_falls_back_without_schemas(logger, monkeypatch):
+    monkeypatch.setattr(backends, "Gio", NoSchemas)
+    assert isinstance(create_backend("auto", logger), SubprocessBackend)
+    assert logger.lines == []
+
+    assert isinstance(create_backend("gio", logger), SubprocessBackend)
+    assert "is not installed" in logger.lines[0][0]
+
+
+def test_subprocess_escapes_uris(logger, monkeypatch):
+    backend = SubprocessBackend(logger)
+    commands = []
+    monkeypatch.setattr(backend, "run", commands.append)
+    backend.set_picture_uri("picture-uri", "/tmp/50% off #1.jpg")
+    assert commands[0][-1] == "file:///tmp/50%25%20off%20%231.jpg"
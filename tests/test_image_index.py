@@ -0,0 +1,194 @@
+import os
+import pytest
+from PIL import Image, PngImagePlugin
+import image_index
+from image_index import ImageIndex, check_image, HASH_SAVE_INTERVAL
+
+
+def save(path, image_format, **options):
+    Image.effect_noise((64, 48), 64).convert('RGB').save(path, format=image_format, **options)
+    return str(path)
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG", "WEBP"])
+def test_valid_image(tmp_path, image_format):
+    entry = check_image(save(tmp_path / "image", image_format))
+    assert 'error' not in entry
+    assert (entry['width'], entry['height']) == (64, 48)
+    assert entry['mtime'] is not None
+
+
+@pytest.mark.parametrize("image_format, options", [("JPEG", {}), ("JPEG", {'progressive': True}), ("PNG", {})])
+def test_truncated_image(tmp_path, image_format, options):
+    path = save(tmp_path / "image", image_format, **options)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) - 20])
+    assert check_image(path)['error'] == f"truncated {image_format}"
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_data_after_the_end_marker(tmp_path, image_format):
+    # ie, the video appended to a motion photo
+    path = save(tmp_path / "image", image_format)
+    with open(path, 'ab') as f:
+        f.write(b"\x00" * 1000)
+    assert 'error' not in check_image(path)
+
+
+def test_not_an_image(tmp_path):
+    path = tmp_path / "notes.jpg"
+    path.write_text("not an image\n")
+    assert 'error' in check_image(str(path))
+
+
+def test_unsupported_format(tmp_path):
+    path = tmp_path / "icon.ico"
+    Image.new('RGB', (32, 32)).save(path, format="ICO")
+    assert check_image(str(path))['error'] == "unsupported format ICO"
+
+
+def test_missing_file(tmp_path):
+    entry = check_image(str(tmp_path / "missing.jpg"))
+    assert 'error' in entry
+    assert entry['mtime'] is None
+
+
+def test_usable_respects_the_decode_limit(tmp_path, logger):
+    index = ImageIndex(logger, str(tmp_path) + "/")
+    index.max_pixels = 1000000
+    assert index.usable({'format': "PNG", 'width': 1000, 'height': 1000})
+    assert not index.usable({'format': "PNG", 'width': 2000, 'height': 1000})
+    # jpeg is decoded at 1/8 scale first
+    assert index.usable({'format': "JPEG", 'width': 8000, 'height': 8000})
+    assert not index.usable({'error': "truncated PNG"})
+
+
+def test_mpo_is_a_jpeg(tmp_path):
+    # ie, a phone photo with a second picture in it
+    path = str(tmp_path / "photo.jpg")
+    im = Image.effect_noise((64, 48), 64).convert('RGB')
+    im.save(path, format="MPO", save_all=True, append_images=[im.transpose(Image.FLIP_LEFT_RIGHT)])
+    entry = check_image(path)
+    assert entry['format'] == "MPO"
+    assert 'error' not in entry
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 4])
+    assert check_image(path)['error'] == "truncated MPO"
+
+
+def test_png_end_marker_earlier_in_the_file(tmp_path):
+    # "IEND" in a text chunk before the image data isn't the end of the file
+    path = str(tmp_path / "image.png")
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "IEND")
+    Image.effect_noise((64, 48), 64).convert('RGB').save(path, pnginfo=info)
+    assert 'error' not in check_image(path)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) - 40])
+    assert check_image(path)['error'] == "truncated PNG"
+
+
+def test_hashes_are_saved_every_so_often(tmp_path, logger, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(image_index, "monotonic", lambda: now[0])
+    index = ImageIndex(logger, str(tmp_path) + "/")
+    index.dirty = True
+
+    index.save_hashes()
+    assert not (tmp_path / ".image_index.json").exists()
+
+    now[0] += HASH_SAVE_INTERVAL
+    index.save_hashes()
+    assert (tmp_path / ".image_index.json").exists()
+    assert not index.dirty
+
+
+@pytest.fixture
+def counted_checks(monkeypatch):
+    """ Names of the files check_image is called on"""
+    checked = []
+    check = image_index.check_image
+
+    def counting(path):
+        checked.append(os.path.basename(path))
+        return check(path)
+    monkeypatch.setattr(image_index, "check_image", counting)
+    return checked
+
+
+def new_index(logger, directory):
+    index = ImageIndex(logger, str(directory) + "/")
+    index.hasher.set_paused(True)
+    return index
+
+
+def test_folder_is_only_rescanned_when_it_changes(tmp_path, logger, counted_checks):
+    folder = tmp_path / "pictures"
+    folder.mkdir()
+    save(folder / "a.jpg", "JPEG")
+    save(folder / "b.png", "PNG")
+    (folder / "notes.txt").write_text("not an image\n")
+
+    index = new_index(logger, tmp_path)
+    assert sorted(index.folder_images(str(folder))) == [str(folder / "a.jpg"), str(folder / "b.png")]
+    assert sorted(counted_checks) == ["a.jpg", "b.png", "notes.txt"]
+    assert "ERROR: 1 invalid image file(s)" in logger.lines[-1][0]
+
+    counted_checks.clear()
+    index.folder_images(str(folder))
+    assert counted_checks == []
+
+    # only the new file is checked, the rest are reused
+    save(folder / "c.jpg", "JPEG")
+    assert len(index.folder_images(str(folder))) == 3
+    assert counted_checks == ["c.jpg"]
+
+
+def test_index_is_reused_across_runs(tmp_path, logger, counted_checks):
+    folder = tmp_path / "pictures"
+    folder.mkdir()
+    save(folder / "a.jpg", "JPEG")
+    index = new_index(logger, tmp_path)
+    index.folder_images(str(folder))
+    index.save()
+
+    counted_checks.clear()
+    index = new_index(logger, tmp_path)
+    assert index.folder_images(str(folder)) == [str(folder / "a.jpg")]
+    assert index.image_info(str(folder / "a.jpg"))['width'] == 64
+    assert counted_checks == []
+
+
+def test_old_or_corrupt_index_is_rebuilt(tmp_path, logger):
+    (tmp_path / ".image_index.json").write_text('{"version": 1, "folders": {"x": {}}}')
+    assert new_index(logger, tmp_path).folders == {}
+    (tmp_path / ".image_index.json").write_text("{not json")
+    assert new_index(logger, tmp_path).folders == {}
+
+
+def test_update_folder(tmp_path, logger, counted_checks):
+    folder = tmp_path / "pictures"
+    folder.mkdir()
+    save(folder / "a.jpg", "JPEG")
+    index = new_index(logger, tmp_path)
+    index.folder_images(str(folder))
+
+    save(folder / "b.jpg", "JPEG")
+    (folder / "a.jpg").unlink()
+    counted_checks.clear()
+    assert index.update_folder(str(folder), [str(folder / "b.jpg")], [str(folder / "a.jpg")]) == [str(folder / "b.jpg")]
+    assert counted_checks == ["b.jpg"]
+    assert index.image_info(str(folder / "a.jpg")) is None
+
+    # the index is in step with the folder, so it isn't rescanned
+    counted_checks.clear()
+    assert index.folder_images(str(folder)) == [str(folder / "b.jpg")]
+    assert counted_checks == []
@@ -0,0 +1,155 @@
+import json
+import pytest
+from PIL import Image
+from main import ConfigReader, ErrorLogger
+
+
+CONFIG = {
+    "service": "compositor",
+    "hydrapaper_stagger": "false",
+    "switch_time": "60",
+    "log_level": "info",
+    "policy_source": "off",
+    "desktop_backend": "fake",
+    "monitor_layout": [{"x": 0, "y": 0, "width": 160, "height": 120},
+                       {"x": 160, "y": 0, "width": 160, "height": 120}],
+    "monitor_timing": "auto",
+    "fit_mode": "auto",
+    "resize_cache_mb": "10",
+    "max_decode_megapixels": "100",
+    "output_format": "jpeg",
+    "output_quality": "95",
+    "folder_weights": {},
+    "image_parent_directory": "",
+    "image_folders": {"monitors": [["left"], ["right"]]},
+}
+
+
+def write_config(directory, **changes):
+    config = dict(CONFIG, image_parent_directory=str(directory / "pictures"), **changes)
+    (directory / "config.json").write_text(json.dumps(config))
+
+
+@pytest.fixture
+def reader(tmp_path, logger):
+    """ A ConfigReader over a compositor config with two image folders"""
+    for name in ("left", "right", "other"):
+        (tmp_path / "pictures" / name).mkdir(parents=True)
+        Image.new('RGB', (64, 48), (0, 0, 128)).save(tmp_path / "pictures" / name / "a.jpg")
+    write_config(tmp_path)
+
+    reader = ConfigReader(logger, str(tmp_path) + "/")
+    assert not reader.critical_error
+    yield reader
+    if reader.watcher is not None:
+        reader.watcher.stop()
+
+
+def reload(reader, directory, **changes):
+    """ Save the config with changes and report it changed, without
+    waiting for the config watcher to notice"""
+    write_config(directory, **changes)
+    reader.config_watcher.changed.set()
+    return reader.check_config_updated()
+
+
+def test_unchanged_config_is_not_reloaded(reader, tmp_path, logger):
+    assert reader.check_config_updated() is False
+    assert reload(reader, tmp_path) is False
+    assert not any("Config File Updated" in message for message, _ in logger.lines)
+
+
+def test_fields_read_every_switch_keep_the_folders(reader, tmp_path):
+    watcher = reader.watcher
+    pools = reader.pool_folders
+
+    assert reload(reader, tmp_path, output_format="png", switch_time="60") is False
+    assert reader.config_data['output_format'] == 'png'
+    assert reader.watcher is watcher
+    assert reader.pool_folders is pools
+
+
+def test_restart_fields_restart_the_display_loop(reader, tmp_path):
+    watcher = reader.watcher
+
+    assert reload(reader, tmp_path, switch_time="120") is True
+    assert reader.config_data['switch_time'] == 120
+    # the folders didn't change, so they aren't rebuilt
+    assert reader.watcher is watcher
+
+
+def test_changed_folders_are_rebuilt(reader, tmp_path):
+    watcher = reader.watcher
+
+    assert reload(reader, tmp_path, image_folders={"monitors": [["left"], ["other"]]}) is True
+    assert reader.watcher is not watcher
+    assert reader.pool_folders["monitors[1]"] == [str(tmp_path / "pictures" / "other")]
+
+
+def test_invalid_json_keeps_the_config(reader, tmp_path, logger):
+    (tmp_path / "config.json").write_text('{"service": ')
+    reader.config_watcher.changed.set()
+
+    assert reader.check_config_updated() is False
+    assert logger.lines[-1][0] == "ERROR: config file is not valid JSON, keeping the current config"
+    assert reader.config_data['service'] == 'compositor'
+
+
+def test_recovering_from_a_critical_error_restarts(reader, tmp_path):
+    assert reload(reader, tmp_path, service="nothing") is True
+    assert reader.critical_error
+    assert reload(reader, tmp_path) is True
+    assert not reader.critical_error
+
+
+@pytest.fixture
+def error_log(tmp_path):
+    """ An ErrorLogger writing to tmp_path, that writes every line as it
+    is logged"""
+    error_log = ErrorLogger(str(tmp_path) + "/")
+    error_log.flush_lines = 1
+    return error_log
+
+
+def logged_lines(path) -> list[str]:
+    """ The messages in a log file, without their times or the header"""
+    return [line[9:] for line in path.read_text().splitlines()[3:] if line]
+
+
+def test_repeated_messages_are_counted(error_log, tmp_path):
+    for _ in range(3):
+        error_log.log("ERROR: folder missing")
+    error_log.log("Switched")
+    error_log.log("Switched")
+    error_log.flush()
+
+    assert logged_lines(tmp_path / "errors.log") == ["ERROR: folder missing",
+                                                     "(last message repeated 2 more time(s))",
+                                                     "Switched",
+                                                     "(last message repeated 1 more time(s))"]
+
+
+def test_messages_below_the_level_are_dropped(error_log, tmp_path):
+    error_log.log("Invalid image file: a.txt", 'debug')
+    error_log.log("Switched")
+    error_log.level = 'error'
+    error_log.log("Switched again")
+    error_log.log("ERROR: folder missing")
+    error_log.flush()
+
+    assert logged_lines(tmp_path / "errors.log") == ["Switched", "ERROR: folder missing"]
+
+
+def test_log_is_rotated_keeping_backups(error_log, tmp_path):
+    error_log.max_bytes = 100
+    error_log.backups = 2
+    for i in range(12):
+        error_log.log(f"message {i} " + "x" * 40)
+    error_log.flush()
+
+    names = sorted(path.name for path in tmp_path.iterdir() if path.name.startswith("errors.log"))
+    assert names == ["errors.log", "errors.log.1", "errors.log.2"]
+    assert (tmp_path / "errors.log").stat().st_size < 100
+    # the newest messages are in the current log, older ones in the backups
+    assert "message 11" in (tmp_path / "errors.log").read_text()
+    assert "message 0 " not in "".join(path.read_text() for path in tmp_path.iterdir() if path.name.startswith("errors.log"))
@@ -0,0 +1,22 @@
+from monitors import parse_xrandr
+
+
+XRANDR = """Screen 0: minimum 320 x 200, current 4480 x 1440, maximum 16384 x 16384
+HDMI-1 connected 1920x1080+2560+0 (normal left inverted right x axis y axis) 527mm x 296mm
+   1920x1080     60.00*+  50.00
+DP-1 connected primary 2560x1440+0+0 (normal left inverted right x axis y axis) 597mm x 336mm
+   2560x1440     59.95*+
+DP-2 disconnected (normal left inverted right x axis y axis)
+eDP-1 connected (normal left inverted right x axis y axis)
+"""
+
+
+def test_parse_xrandr_active_monitors_left_to_right():
+    assert parse_xrandr(XRANDR) == [
+        {'x': 0, 'y': 0, 'width': 2560, 'height': 1440, 'scale': 1},
+        {'x': 2560, 'y': 0, 'width': 1920, 'height': 1080, 'scale': 1},
+    ]
+
+
+def test_parse_xrandr_nothing_connected():
+    assert parse_xrandr("Screen 0: minimum 320 x 200\nDP-1 disconnected (normal)\n") == []
@@ -0,0 +1,68 @@
+import json
+import pytest
+from policy import StubSource, PowerPolicy, CHECK_INTERVAL
+import policy
+
+
+CONFIG = {'policy_source': 'stub', 'pause_when_locked': True, 'battery_stretch': 3, 'max_load_percent': 50}
+
+
+def write_stub(path, state):
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def test_stub_source_defaults_without_a_file(tmp_path):
+    source = StubSource(str(tmp_path / "missing.json"))
+    assert not source.screen_off()
+    assert not source.on_battery()
+    assert source.load() == 0.0
+
+
+def test_stub_source_reads_state(tmp_path):
+    path = tmp_path / "stub.json"
+    write_stub(path, {'screen_off': True, 'on_battery': True, 'load': 0.75})
+    source = StubSource(str(path))
+    assert source.screen_off()
+    assert source.on_battery()
+    assert source.load() == 0.75
+
+
+@pytest.mark.parametrize("contents", ["not json", "[1, 2]", '{"load": "lots"}'])
+def test_stub_source_ignores_bad_files(tmp_path, contents):
+    path = tmp_path / "stub.json"
+    path.write_text(contents)
+    source = StubSource(str(path))
+    assert not source.screen_off()
+    assert source.load() == 0.0
+
+
+def test_policy_off_is_normal(tmp_path, logger):
+    power = PowerPolicy(logger, str(tmp_path) + "/")
+    write_stub(power.stub_path, {'screen_off': True})
+    assert power.check({'policy_source': 'off'}) == PowerPolicy.normal
+
+
+def test_policy_holds_back_and_recovers(tmp_path, logger, monkeypatch):
+    power = PowerPolicy(logger, str(tmp_path) + "/")
+    now = [1000.0]
+    monkeypatch.setattr(policy, "monotonic", lambda: now[0])
+
+    write_stub(power.stub_path, {'screen_off': True, 'on_battery': True, 'load': 0.9})
+    assert power.check(CONFIG) == {'paused': True, 'stretch': 3, 'prerender': False}
+    assert logger.lines[-1][0].startswith("Holding back:")
+
+    # reused until CHECK_INTERVAL has passed
+    write_stub(power.stub_path, {})
+    assert power.check(CONFIG)['paused']
+    now[0] += CHECK_INTERVAL
+    assert power.check(CONFIG) == PowerPolicy.normal
+    assert logger.lines[-1][0] == "Switching normally again"
+
+
+def test_policy_respects_config(tmp_path, logger):
+    power = PowerPolicy(logger, str(tmp_path) + "/")
+    write_stub(power.stub_path, {'screen_off': True, 'on_battery': True, 'load': 0.9})
+    config = dict(CONFIG, pause_when_locked=False, battery_stretch=1, max_load_percent=0)
+    assert power.check(config) == PowerPolicy.normal
+    assert logger.lines == []
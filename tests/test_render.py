@@ -0,0 +1,198 @@
+import os
+import pytest
+from PIL import Image
+from render import PreRenderer, ResizeCache, fit_boxes, load_resized
+
+
+def test_stretch_uses_the_whole_source():
+    assert fit_boxes((4000, 3000), (1920, 1080), 'stretch') == ((0, 0, 4000, 3000), (1920, 1080), (0, 0))
+
+
+def test_zoom_crops_to_the_monitor_shape():
+    box, size, offset = fit_boxes((4000, 3000), (1920, 1080), 'zoom')
+    assert size == (1920, 1080)
+    assert offset == (0, 0)
+    left, top, right, bottom = box
+    # full width is kept, the height is cropped evenly top and bottom
+    assert (left, right) == (0, 4000)
+    assert bottom - top == pytest.approx(4000 * 1080 / 1920)
+    assert top == pytest.approx(3000 - bottom)
+
+
+def test_fit_letterboxes():
+    box, size, offset = fit_boxes((1000, 1000), (1920, 1080), 'fit')
+    assert box == (0, 0, 1000, 1000)
+    assert size == (1080, 1080)
+    assert offset == (420, 0)
+
+
+def test_center_crops_large_images():
+    assert fit_boxes((4000, 3000), (1920, 1080), 'center') == ((1040, 960, 2960, 2040), (1920, 1080), (0, 0))
+
+
+def test_center_pads_small_images():
+    assert fit_boxes((800, 600), (1920, 1080), 'center') == ((0, 0, 800, 600), (800, 600), (560, 240))
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P", "L", "1", "LA"])
+def test_load_resized_any_mode_gives_rgb(tmp_path, logger, mode):
+    path = tmp_path / "image.png"
+    Image.effect_noise((400, 300), 64).convert(mode).save(path)
+    im = load_resized(str(path), (160, 90), 'zoom', 1000000, logger)
+    assert (im.mode, im.size) == ("RGB", (160, 90))
+
+
+def test_load_resized_over_the_limit(tmp_path, logger):
+    path = tmp_path / "image.png"
+    Image.new('RGB', (400, 300)).save(path)
+    with pytest.raises(ValueError):
+        load_resized(str(path), (160, 90), 'zoom', 100000, logger)
+
+
+def make_sources(tmp_path, count):
+    # the same picture in each, so cached copies are all the same size
+    im = Image.effect_noise((320, 240), 64).convert('RGB')
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"source{i}.png"
+        im.save(path)
+        paths.append(str(path))
+    return paths
+
+
+def test_cache_hit_and_stale_source(tmp_path, logger):
+    source, = make_sources(tmp_path, 1)
+    cache = ResizeCache(logger, str(tmp_path) + "/", 10 * 1024 * 1024, 1000000)
+    first = cache.load(source, (160, 120), 'zoom')
+    cached = cache.key_path(source, (160, 120), 'zoom')
+    assert os.path.isfile(cached)
+    assert cache.total_bytes == os.path.getsize(cached)
+
+    assert cache.load(source, (160, 120), 'zoom').size == first.size
+    assert len(os.listdir(cache.path)) == 1
+
+    # a replaced source is a new entry, never the old copy
+    Image.new('RGB', (320, 240), 'red').save(source)
+    assert cache.key_path(source, (160, 120), 'zoom') != cached
+    assert cache.load(source, (160, 120), 'zoom').getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_cache_evicts_least_recently_used(tmp_path, logger):
+    sources = make_sources(tmp_path, 3)
+    cache = ResizeCache(logger, str(tmp_path) + "/", 10 * 1024 * 1024, 1000000)
+    cached = []
+    for source in sources[:2]:
+        cache.load(source, (160, 120), 'zoom')
+        cached.append(cache.key_path(source, (160, 120), 'zoom'))
+    # source0 was used after source1, so source1 goes first
+    os.utime(cached[1], (1000, 1000))
+    os.utime(cached[0], (2000, 2000))
+
+    cache.max_bytes = cache.total_bytes + 1
+    cache.load(sources[2], (160, 120), 'zoom')
+    assert os.path.isfile(cached[0])
+    assert not os.path.isfile(cached[1])
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.total_bytes == sum(entry.stat().st_size for entry in os.scandir(cache.path))
+
+
+def test_cache_off(tmp_path, logger):
+    source, = make_sources(tmp_path, 1)
+    cache = ResizeCache(logger, str(tmp_path) + "/", 0, 1000000)
+    assert cache.load(source, (160, 120), 'fit').size == (160, 120)
+    assert os.listdir(cache.path) == []
+
+
+def test_cache_counts_files_from_earlier_runs(tmp_path, logger):
+    source, = make_sources(tmp_path, 1)
+    ResizeCache(logger, str(tmp_path) + "/", 10 * 1024 * 1024, 1000000).load(source, (160, 120), 'zoom')
+    cache = ResizeCache(logger, str(tmp_path) + "/", 10 * 1024 * 1024, 1000000)
+    assert cache.total_bytes == os.path.getsize(cache.key_path(source, (160, 120), 'zoom'))
+
+
+LAYOUT = [{'x': 0, 'y': 0, 'width': 160, 'height': 120, 'scale': 1},
+          {'x': 160, 'y': 0, 'width': 160, 'height': 120, 'scale': 1}]
+
+
+@pytest.fixture
+def prerenderer(tmp_path, logger):
+    cache = ResizeCache(logger, str(tmp_path) + "/", 10 * 1024 * 1024, 1000000)
+    prerenderer = PreRenderer(logger, str(tmp_path) + "/", cache, lambda path: None)
+    prerenderer.set_layout(LAYOUT, ['zoom', 'fit'])
+    return prerenderer
+
+
+def test_submit_then_swap_in(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 2)
+    prerenderer.submit(sources)
+    assert prerenderer.swap_in(sources)
+    with Image.open(prerenderer.output_path) as im:
+        assert im.size == (320, 120)
+    assert not os.path.exists(prerenderer.staging_path)
+
+
+def test_swap_in_without_submit_waits(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 2)
+    assert prerenderer.swap_in(sources[::-1])
+    assert os.path.isfile(prerenderer.output_path)
+
+
+def test_failed_set_is_not_rendered_again(tmp_path, logger, prerenderer):
+    source, = make_sources(tmp_path, 1)
+    big = str(tmp_path / "big.png")
+    Image.new('RGB', (2000, 1000)).save(big)
+
+    assert not prerenderer.swap_in([source, big])
+    prerenderer.submit([source, big])
+    assert not prerenderer.swap_in([source, big])
+    errors = [message for message, _ in logger.lines if message.startswith("ERROR: could not join")]
+    assert len(errors) == 1
+
+    # a different set renders as normal
+    assert prerenderer.swap_in([source, source])
+
+
+def test_cancel_drops_the_queued_set(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 2)
+    prerenderer.submit(sources)
+    prerenderer.cancel()
+    with prerenderer.condition:
+        assert prerenderer.job is None and prerenderer.ready is None
+
+
+def test_inline_renders_on_the_calling_thread(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 2)
+    prerenderer.inline = True
+    prerenderer.submit(sources)
+    assert prerenderer.job is None
+    assert prerenderer.swap_in(sources)
+    assert os.path.isfile(prerenderer.output_path)
+
+
+def test_buffers_alternate(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 3)
+    shown = []
+    for paths in ([sources[0], sources[1]], [sources[1], sources[2]], [sources[2], sources[0]]):
+        assert prerenderer.swap_in(paths)
+        shown.append(os.path.basename(prerenderer.output_path))
+    assert shown == [".joined_file.1.jpg", ".joined_file.0.jpg", ".joined_file.1.jpg"]
+
+
+def test_output_format_change(tmp_path, prerenderer):
+    sources = make_sources(tmp_path, 3)
+    assert prerenderer.swap_in(sources[:2])
+    assert prerenderer.swap_in(sources[1:])
+    on_screen = prerenderer.output_path
+    prerenderer.submit([sources[0], sources[2]])
+
+    # the upcoming set is rendered again in the new format, and old
+    # files go, apart from the one on screen
+    prerenderer.set_output('png', 1)
+    assert prerenderer.cache.lossless
+    with prerenderer.condition:
+        assert (sources[0], sources[2]) in (prerenderer.job, prerenderer.pending, prerenderer.ready)
+    assert os.path.isfile(on_screen)
+
+    assert prerenderer.swap_in([sources[0], sources[2]])
+    assert prerenderer.output_path.endswith(".png")
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith(".joined_file")) == [os.path.basename(prerenderer.output_path)]
@@ -0,0 +1,53 @@
+import pytest
+from scheduler import Scheduler, stagger_timing, LATE_TOLERANCE
+
+
+def test_stagger_timing_off():
+    assert stagger_timing(3, 60, False) == [(60, 60)] * 3
+    assert stagger_timing(1, 60, True) == [(60, 60)]
+
+
+def test_stagger_timing_spreads_changes():
+    # the last monitor first, then the first, second, and so on
+    assert stagger_timing(3, 60, True) == [(60, 40), (60, 60), (60, 20)]
+
+
+def test_advance_keeps_cadence(logger):
+    scheduler = Scheduler([(10, 10)], logger, start=100)
+    assert scheduler.next_deadline() == 110
+
+    # finishing a little after the deadline doesn't cause drift
+    scheduler.advance([0], 110.2)
+    assert scheduler.deadlines == [120]
+    assert scheduler.late_ticks == 0
+
+
+def test_advance_logs_late_and_skipped(logger):
+    scheduler = Scheduler([(10, 10), (10, 5)], logger, start=100)
+    assert scheduler.next_monitors() == [1]
+
+    scheduler.advance([0], 135)
+    assert scheduler.deadlines[0] == 140
+    assert scheduler.late_ticks == 1
+    assert scheduler.skipped_ticks == 2
+    assert scheduler.deadlines[1] == 105
+
+    # within the tolerance isn't counted as late
+    scheduler.advance([1], 105 + LATE_TOLERANCE / 2)
+    assert scheduler.late_ticks == 1
+    assert scheduler.deadlines[1] == 115
+
+
+def test_advance_stretch(logger):
+    scheduler = Scheduler([(10, 10)], logger, start=0)
+    scheduler.stretch = 3
+    scheduler.advance([0], 10)
+    assert scheduler.deadlines == [40]
+
+
+def test_delay_pushes_every_deadline(logger):
+    scheduler = Scheduler(stagger_timing(2, 10, True), logger, start=0)
+    before = list(scheduler.deadlines)
+    scheduler.delay(7.5)
+    assert scheduler.deadlines == [pytest.approx(deadline + 7.5) for deadline in before]
+    assert scheduler.late_ticks == 0
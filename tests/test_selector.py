@@ -0,0 +1,109 @@
+import json
+import pytest
+from image_index import ImageIndex
+from selector import ImageSelector, permute, STATE_VERSION
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 16, 17, 100, 1000])
+def test_permute_is_a_permutation(size):
+    order = [permute(i, size, 12345) for i in range(size)]
+    assert sorted(order) == list(range(size))
+
+
+def test_permute_same_seed_same_order():
+    assert [permute(i, 50, 7) for i in range(50)] == [permute(i, 50, 7) for i in range(50)]
+
+
+def test_permute_seed_changes_order():
+    orders = {tuple(permute(i, 50, seed) for i in range(50)) for seed in range(5)}
+    assert len(orders) == 5
+    assert tuple(range(50)) not in orders
+
+
+def add_folder(index, folder, count, width=64, height=48):
+    """ Put count images in the index under folder, without any files"""
+    files = {f"{i:02}.jpg": {'mtime': 1, 'size': 1, 'format': "JPEG", 'width': width, 'height': height}
+             for i in range(count)}
+    index.folders[folder] = {'mtime': 1, 'files': files}
+    return files
+
+
+@pytest.fixture
+def index(tmp_path, logger):
+    index = ImageIndex(logger, str(tmp_path) + "/")
+    index.hasher.set_paused(True)
+    return index
+
+
+def test_every_image_is_shown_once_per_cycle(index, tmp_path, logger):
+    add_folder(index, "/a", 10)
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+
+    shown = [selector.next_image(["/a"], {}) for _ in range(10)]
+    assert sorted(shown) == [f"/a/{i:02}.jpg" for i in range(10)]
+
+
+def test_order_carries_on_after_a_restart(index, tmp_path, logger):
+    add_folder(index, "/a", 10)
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+    shown = [selector.next_image(["/a"], {}) for _ in range(4)]
+    selector.save()
+
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+    shown += [selector.next_image(["/a"], {}) for _ in range(6)]
+    assert sorted(shown) == [f"/a/{i:02}.jpg" for i in range(10)]
+
+
+def test_old_state_is_dropped(index, tmp_path, logger):
+    (tmp_path / ".shuffle_state.json").write_text(json.dumps({'version': STATE_VERSION - 1, 'folders': {"/a": {}}}))
+    assert ImageSelector(logger, str(tmp_path) + "/", index).folders == {}
+
+
+def test_folders_with_no_weight_are_not_picked(index, tmp_path, logger):
+    add_folder(index, "/a", 3)
+    add_folder(index, "/b", 3)
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+
+    picked = {selector.next_image(["/a", "/b"], {"/a": 0}) for _ in range(20)}
+    assert all(path.startswith("/b/") for path in picked)
+
+    # unless no folder with images has any weight
+    assert selector.next_image(["/a"], {"/a": 0}).startswith("/a/")
+    assert selector.next_image(["/c"], {}) is None
+
+
+def test_images_on_other_monitors_are_avoided(index, tmp_path, logger):
+    add_folder(index, "/a", 2)
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+
+    for _ in range(10):
+        assert selector.next_image(["/a"], {}, avoid={"/a/00.jpg"}) == "/a/01.jpg"
+
+    # with nothing else to show, an image already on screen is used
+    add_folder(index, "/b", 1)
+    assert selector.next_image(["/b"], {}, avoid={"/b/00.jpg"}) == "/b/00.jpg"
+
+
+def test_only_the_largest_copy_of_a_picture_is_picked(index, tmp_path, logger):
+    small = add_folder(index, "/a", 3)
+    large = add_folder(index, "/b", 1, 640, 480)
+    picture = 0x0123456789abcdef
+    small["00.jpg"]['dhash'] = picture ^ 0b1011  # the same picture, resized
+    small["01.jpg"]['dhash'] = picture ^ 0xffff  # a different one
+    large["00.jpg"]['dhash'] = picture
+    # 02.jpg isn't hashed yet, so it can't be a duplicate
+    index.hash_version += 1
+
+    selector = ImageSelector(logger, str(tmp_path) + "/", index)
+    assert selector.skipped(["/a", "/b"]) == {"/a": {"00.jpg"}, "/b": set()}
+    assert logger.lines[-1][0] == "Skipping 1 near-duplicate image(s) in ['/a', '/b']"
+
+    picked = {selector.next_image(["/a"], {}) for _ in range(10)}
+    assert picked == {"/a/00.jpg", "/a/01.jpg", "/a/02.jpg"}
+    picked = {selector.next_image(["/a", "/b"], {}) for _ in range(30)}
+    assert picked == {"/a/01.jpg", "/a/02.jpg", "/b/00.jpg"}
+
+    # the lookup is redone when new hashes come in
+    small["02.jpg"]['dhash'] = picture
+    index.hash_version += 1
+    assert selector.skipped(["/a", "/b"]) == {"/a": {"00.jpg", "02.jpg"}, "/b": set()}
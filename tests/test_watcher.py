@@ -0,0 +1,99 @@
+import os
+import time
+import pytest
+import watcher
+from watcher import FolderWatcher, IN_Q_OVERFLOW
+
+
+def wait_for_changes(folder_watcher, count, timeout=5):
+    """ Collect changes until there are count of them or timeout passes"""
+    changes = []
+    end = time.monotonic() + timeout
+    while len(changes) < count and time.monotonic() < end:
+        changes += folder_watcher.pending_changes()
+        time.sleep(0.05)
+    return changes
+
+
+@pytest.fixture
+def folder(tmp_path):
+    (tmp_path / "old.jpg").write_text("old")
+    return str(tmp_path)
+
+
+def test_added_overwritten_and_removed(folder):
+    folder_watcher = FolderWatcher({folder: ["old.jpg"]})
+    try:
+        with open(folder + "/new.jpg", 'w') as f:
+            f.write("new")
+        with open(folder + "/old.jpg", 'w') as f:
+            f.write("changed")
+        assert wait_for_changes(folder_watcher, 2) == [
+            (folder, [folder + "/new.jpg"], []),
+            # written over in place, so it is checked again
+            (folder, [folder + "/old.jpg"], [folder + "/old.jpg"]),
+        ]
+
+        os.remove(folder + "/new.jpg")
+        assert wait_for_changes(folder_watcher, 1) == [(folder, [], [folder + "/new.jpg"])]
+    finally:
+        folder_watcher.stop()
+
+
+def test_polls_without_inotify(folder, monkeypatch):
+    def no_inotify():
+        raise OSError("inotify not available")
+    monkeypatch.setattr(watcher, "Inotify", no_inotify)
+
+    folder_watcher = FolderWatcher({folder: ["old.jpg"]}, poll_interval=0.1)
+    try:
+        assert folder_watcher.polled == [folder]
+        # the folder mtime has to change for it to be listed again
+        time.sleep(0.02)
+        with open(folder + "/new.jpg", 'w') as f:
+            f.write("new")
+        assert wait_for_changes(folder_watcher, 1) == [(folder, [folder + "/new.jpg"], [])]
+    finally:
+        folder_watcher.stop()
+
+
+def test_polls_folders_that_cant_be_watched(folder, tmp_path_factory, monkeypatch):
+    other = str(tmp_path_factory.mktemp("other"))
+    add_watch = watcher.Inotify.add_watch
+
+    def limited(self, path, mask):
+        if path == other:
+            raise OSError(28, "no space left on device")
+        return add_watch(self, path, mask)
+    monkeypatch.setattr(watcher.Inotify, "add_watch", limited)
+
+    folder_watcher = FolderWatcher({folder: ["old.jpg"], other: []}, poll_interval=0.1)
+    try:
+        assert folder_watcher.polled == [other]
+        time.sleep(0.02)
+        with open(other + "/new.jpg", 'w') as f:
+            f.write("new")
+        assert wait_for_changes(folder_watcher, 1) == [(other, [other + "/new.jpg"], [])]
+    finally:
+        folder_watcher.stop()
+
+
+def test_overflow_relists_every_folder(folder, monkeypatch):
+    folder_watcher = FolderWatcher({folder: ["old.jpg", "gone.jpg"]})
+    try:
+        # events were dropped, so the folder is listed to find what changed
+        with open(folder + "/new.jpg", 'w') as f:
+            f.write("new")
+        wait_for_changes(folder_watcher, 1)
+        read_events = folder_watcher.inotify.read_events
+        overflowed = []
+
+        def overflow(timeout):
+            if not overflowed:
+                overflowed.append(True)
+                return [(-1, IN_Q_OVERFLOW, "")]
+            return read_events(timeout)
+        monkeypatch.setattr(folder_watcher.inotify, "read_events", overflow)
+        assert wait_for_changes(folder_watcher, 1) == [(folder, [], [folder + "/gone.jpg"])]
+    finally:
+        folder_watcher.stop()
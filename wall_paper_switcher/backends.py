@@ -0,0 +1,173 @@
+"""
+@brief - ways of actually setting the desktop wallpaper.
+
+         GioBackend talks to GSettings in-process, keeping one connection to
+         dconf open, instead of starting a shell and gsettings (or a whole
+         flatpak sandbox for hydrapaper) on every switch.
+         SubprocessBackend runs the gsettings/hydrapaper commands as before,
+         and is used when PyGObject isn't installed.
+         FakeBackend only records what it was asked to do, for running
+         without a desktop session.
+"""
+
+
+import subprocess  # to run gsettings/hydrapaper for the fallback backend
+from pathlib import Path  # to turn paths into file URIs without Gio
+
+# PyGObject is optional, the subprocess backend is used without it
+try:
+    from gi.repository import Gio
+except ImportError:
+    Gio = None
+
+
+BACKGROUND_SCHEMA = "org.gnome.desktop.background"
+
+
+class DesktopBackend():
+    """
+            Base class for setting the wallpaper. Paths are plain file
+            paths, each backend turns them into whatever it needs.
+    """
+
+    name = "none"
+
+    def set_picture_options(self, mode : str):
+        """ Set how the image is fit to the screen, ie, 'zoom' or 'spanned'"""
+        raise NotImplementedError
+
+    def set_picture_uri(self, key : str, path : str):
+        """ Set the wallpaper image, key is 'picture-uri' or 'picture-uri-dark'"""
+        raise NotImplementedError
+
+    def set_monitor_images(self, image_paths : list[str], joined_path : str):
+        """ Show one image per monitor. joined_path is the images already
+        joined side by side, for backends that span it themselves"""
+        raise NotImplementedError
+
+    def set_spanned_image(self, path : str):
+        """ Span one image across all monitors, for light and dark themes"""
+        raise NotImplementedError
+
+
+class GioBackend(DesktopBackend):
+    """
+            Set the wallpaper through Gio.Settings. Raises OSError when
+            created if PyGObject or the GNOME background schema is missing.
+
+            Class Members:
+                settings : Gio.Settings - the org.gnome.desktop.background settings
+    """
+
+    name = "gio"
+
+    def __init__(self):
+
+        if Gio is None:
+            raise OSError("PyGObject is not installed")
+        # there is no default source at all when no schemas are installed
+        source = Gio.SettingsSchemaSource.get_default()
+        if source is None or source.lookup(BACKGROUND_SCHEMA, True) is None:
+            raise OSError(f"schema '{BACKGROUND_SCHEMA}' is not installed")
+        self.settings = Gio.Settings.new(BACKGROUND_SCHEMA)
+
+    def set_picture_options(self, mode : str):
+        self.settings.set_string("picture-options", mode)
+        Gio.Settings.sync()
+
+    def set_picture_uri(self, key : str, path : str):
+        self.settings.set_string(key, Gio.File.new_for_path(path).get_uri())
+        Gio.Settings.sync()
+
+    def set_monitor_images(self, image_paths : list[str], joined_path : str):
+        # same as hydrapaper does, span the joined image across the screens
+        self.set_spanned_image(joined_path)
+
+    def set_spanned_image(self, path : str):
+        uri = Gio.File.new_for_path(path).get_uri()
+        self.settings.set_string("picture-options", "spanned")
+        self.settings.set_string("picture-uri", uri)
+        self.settings.set_string("picture-uri-dark", uri)
+        Gio.Settings.sync()
+
+
+class SubprocessBackend(DesktopBackend):
+    """
+            Set the wallpaper by running the gsettings and hydrapaper
+            commands. Errors from the commands are logged.
+
+            Class Members:
+                logger : ErrorLogger - where failed commands are logged
+    """
+
+    name = "subprocess"
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def run(self, command : list[str]):
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.logger.log(f"ERROR: could not run {command[0]}: {e}")
+            return
+        if result.returncode != 0:
+            self.logger.log(f"ERROR: {' '.join(command)} failed: {result.stderr.decode(errors='replace').strip()}")
+
+    def set_picture_options(self, mode : str):
+        self.run(["gsettings", "set", BACKGROUND_SCHEMA, "picture-options", mode])
+
+    def set_picture_uri(self, key : str, path : str):
+        # escaped, so a '%' or '#' in the path isn't read as part of the uri
+        self.run(["gsettings", "set", BACKGROUND_SCHEMA, key, Path(path).absolute().as_uri()])
+
+    def set_monitor_images(self, image_paths : list[str], joined_path : str):
+        self.run(["flatpak", "run", "org.gabmus.hydrapaper", "-c"] + list(image_paths))
+
+    def set_spanned_image(self, path : str):
+        self.set_picture_options("spanned")
+        self.set_picture_uri("picture-uri", path)
+        self.set_picture_uri("picture-uri-dark", path)
+
+
+class FakeBackend(DesktopBackend):
+    """
+            Record every call instead of changing the desktop.
+
+            Class Members:
+                calls : list - (method name, arguments) for each call, in order
+    """
+
+    name = "fake"
+
+    def __init__(self):
+        self.calls = []
+
+    def set_picture_options(self, mode : str):
+        self.calls.append(("set_picture_options", (mode,)))
+
+    def set_picture_uri(self, key : str, path : str):
+        self.calls.append(("set_picture_uri", (key, path)))
+
+    def set_monitor_images(self, image_paths : list[str], joined_path : str):
+        self.calls.append(("set_monitor_images", (list(image_paths), joined_path)))
+
+    def set_spanned_image(self, path : str):
+        self.calls.append(("set_spanned_image", (path,)))
+
+
+def create_backend(name : str, logger) -> DesktopBackend:
+    """ Return the backend for the 'desktop_backend' config value. 'auto'
+    and 'gio' fall back to running commands if Gio can't be used"""
+    if name == "fake":
+        return FakeBackend()
+
+    if name in ("auto", "gio"):
+        try:
+            return GioBackend()
+        except OSError as e:
+            if name == "gio":
+                logger.log(f"ERROR: can't use 'gio' desktop backend, {e}")
+                logger.log("Using 'subprocess'")
+
+    return SubprocessBackend(logger)
@@ -0,0 +1,295 @@
+"""
+@brief - measures how fast the switcher scans folders, checks images, and
+         builds the joined wallpaper, without a desktop session.
+
+         A tree of generated images (and some files that aren't images) is
+         made in a temp folder, then each stage is run in-process the same
+         way the switcher runs it, with the fake desktop backend. Reports
+         throughput, latency percentiles and peak memory, so changes to the
+         cache, draft decoding or the thread pools can be compared.
+
+         Scanning, checking, resizing and joining are also run the way the
+         switcher did them before the index, draft decoding and the resize
+         cache, ie, by file extension and full decodes, and each stage is
+         reported next to its legacy run as a baseline.
+
+         ie) python3 benchmark.py --images 200 2000 --formats jpeg png
+"""
+
+
+import os  # to build the image tree
+import sys  # to exit with an error
+import shutil  # to copy images and remove the tree
+import random  # to vary image sizes and formats
+import argparse  # for the options
+import resource  # for peak memory use
+import tempfile  # where the tree is made
+from time import perf_counter  # to time each stage
+from PIL import Image  # to make the images
+from main import ErrorLogger  # the same log the switcher writes
+from image_index import ImageIndex, check_image, dhash  # scanning and checking
+from render import PreRenderer, ResizeCache, load_resized, OUTPUT_FORMATS  # resizing and joining
+from backends import FakeBackend  # sets nothing
+from monitors import default_layout  # monitors to join images for
+from stats import Timings, format_summary, timings  # latency percentiles
+
+
+# sizes of the generated images, picked at random
+IMAGE_SIZES = [(1920, 1080), (2560, 1440), (3840, 2160), (6000, 4000)]
+
+# 'format' option -> (Pillow format, file extension)
+IMAGE_FORMATS = {'jpeg': ("JPEG", ".jpg"), 'png': ("PNG", ".png"), 'webp': ("WEBP", ".webp")}
+
+# unique images made per size and format, the rest of the tree is copies
+UNIQUE_IMAGES = 2
+
+# the extensions the legacy scan took to be images
+LEGACY_EXTENSIONS = [".webp", ".svg", ".png", ".jpeg", ".jpg"]
+
+# the size the legacy join assumed every monitor was
+LEGACY_SIZE = (1920, 1080)
+
+
+def peak_rss_mb() -> float:
+    """ Peak memory use of this process so far, ru_maxrss is in kilobytes on linux"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_tree(parent : str, count : int, folders : int, formats : list[str], junk : float) -> int:
+    """ Fill parent with folders sub-folders holding count images between
+    them, in the given formats, plus about junk * count files that aren't
+    valid images. Returns the number of junk files"""
+    # a few real images of each kind, copied to make up the count, as
+    # encoding thousands of large images would take longer than the benchmark
+    originals = []
+    for width, height in IMAGE_SIZES:
+        for image_format in formats:
+            for i in range(UNIQUE_IMAGES):
+                path = os.path.join(parent, f".original_{width}x{height}_{i}{IMAGE_FORMATS[image_format][1]}")
+                noise = Image.effect_noise((width // 8, height // 8), 64 + 16 * i).resize((width, height))
+                # png is saved with light compression, the default takes far longer
+                Image.merge('RGB', (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(Image.FLIP_TOP_BOTTOM))).save(
+                    path, format=IMAGE_FORMATS[image_format][0], compress_level=1)
+                originals.append(path)
+
+    for folder in range(folders):
+        os.makedirs(os.path.join(parent, f"folder{folder}"))
+    for i in range(count):
+        original = random.choice(originals)
+        shutil.copyfile(original, os.path.join(parent, f"folder{i % folders}", f"image{i}{os.path.splitext(original)[1]}"))
+
+    # text files, truncated jpegs, and images saved in formats it doesn't use
+    junk_count = int(count * junk)
+    for i in range(junk_count):
+        path = os.path.join(parent, f"folder{i % folders}", f"junk{i}")
+        kind = i % 3
+        if kind == 0:
+            with open(path + ".txt", 'w') as f:
+                f.write("not an image\n" * 10)
+        elif kind == 1:
+            with open(originals[0], 'rb') as f:
+                data = f.read()
+            with open(path + ".jpg", 'wb') as f:
+                f.write(data[:len(data) // 2])
+        else:
+            Image.new('RGB', (64, 64)).save(path + ".ico", format="ICO")
+
+    for path in originals:
+        os.remove(path)
+    return junk_count
+
+
+def report(title : str, count : int, seconds : float, legacy : float = None) -> float:
+    """ Print the throughput of a stage, and how many times faster it was
+    than the legacy run taking legacy seconds, if given. Returns seconds"""
+    rate = count / seconds if seconds > 0 else float('inf')
+    line = f"{title:<36}{count:>8} in {seconds:>8.3f}s  {rate:>10.1f}/s  peak {peak_rss_mb()} MB"
+    if legacy is not None:
+        line += f"  {legacy / seconds if seconds > 0 else float('inf'):>6.1f}x legacy"
+    print(line)
+    return seconds
+
+
+def legacy_scan(logger, folders : list[str]) -> list[str]:
+    """ List folders the legacy way, taking any file with an image
+    extension to be valid, and logging every other file"""
+    valid_files = []
+    for folder in folders:
+        for file in [f.path for f in os.scandir(folder)]:
+            if any(file.lower().endswith(ext) for ext in LEGACY_EXTENSIONS):
+                valid_files.append(file)
+            else:
+                logger.log(f"ERROR: Invalid image file: {file}")
+    return valid_files
+
+
+def legacy_decode(path : str) -> bool:
+    """ Check an image the legacy way, by decoding all of it"""
+    try:
+        with Image.open(path) as im:
+            im.load()
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return False
+
+
+def legacy_join(directory : str, image_paths : list[str]):
+    """ Join images the legacy way, decoding each in full and stretching
+    it to LEGACY_SIZE with LANCZOS, with no cache"""
+    images = [Image.open(x).resize(LEGACY_SIZE, Image.LANCZOS) for x in image_paths]
+    new_im = Image.new('RGB', (LEGACY_SIZE[0] * len(images), LEGACY_SIZE[1]))
+    for i, im in enumerate(images):
+        new_im.paste(im, (LEGACY_SIZE[0] * i, 0))
+    new_im.save(directory + ".joined_file.jpg")
+
+
+def bench_scan(logger, parent : str, folders : list[str]):
+    """ Index every folder from nothing, then again with nothing changed.
+    The background hasher is kept paused, so it doesn't take CPU from the
+    stages timed after this one"""
+    start = perf_counter()
+    legacy_files = legacy_scan(logger, folders)
+    legacy = report("scan, legacy extensions", len(legacy_files), perf_counter() - start)
+
+    index = ImageIndex(logger, parent)
+    index.hasher.set_paused(True)
+    start = perf_counter()
+    images = [path for folder in folders for path in index.folder_images(folder)]
+    report("scan, cold index", sum(len(index.folders[folder]['files']) for folder in folders), perf_counter() - start, legacy)
+
+    start = perf_counter()
+    for folder in folders:
+        index.folder_images(folder)
+    report("scan, unchanged folders", len(folders), perf_counter() - start, legacy)
+    return index, images
+
+
+def bench_validate(folders : list[str], limit : int):
+    """ Check files one at a time, to compare with the parallel cold scan,
+    and against decoding each one in full"""
+    paths = [os.path.join(folder, name) for folder in folders for name in sorted(os.listdir(folder))][:limit]
+    start = perf_counter()
+    for path in paths:
+        legacy_decode(path)
+    legacy = report("validate, legacy full decode", len(paths), perf_counter() - start)
+
+    start = perf_counter()
+    for path in paths:
+        check_image(path)
+    report("validate, one thread", len(paths), perf_counter() - start, legacy)
+
+
+def bench_hash(images : list[str], limit : int):
+    """ Perceptual hash images one at a time"""
+    paths = images[:limit]
+    start = perf_counter()
+    for path in paths:
+        dhash(path, 1000 * 1000000)
+    report("perceptual hash, one thread", len(paths), perf_counter() - start)
+
+
+def bench_resize(logger, images : list[str], size : tuple, limit : int) -> Timings:
+    """ Resize images to a monitor, straight from the source each time,
+    the legacy way and with draft decoding"""
+    latency = Timings()
+    paths = images[:limit]
+    start = perf_counter()
+    for path in paths:
+        with latency.time("legacy " + os.path.splitext(path)[1][1:]):
+            Image.open(path).resize(size, Image.LANCZOS)
+    legacy = report(f"resize to {size[0]}x{size[1]}, legacy", len(paths), perf_counter() - start)
+
+    start = perf_counter()
+    for path in paths:
+        with latency.time("resize " + os.path.splitext(path)[1][1:]):
+            load_resized(path, size, 'zoom', 1000 * 1000000, logger)
+    report(f"resize to {size[0]}x{size[1]}", len(paths), perf_counter() - start, legacy)
+    return latency
+
+
+def bench_compose(logger, parent : str, index : ImageIndex, images : list[str], monitors : int,
+                  switches : int, cache_mb : int, output_format : str) -> Timings:
+    """ Build and set the joined image for switches sets of images, like
+    the compositor loop does, once the legacy way, then with a cold cache
+    and once warm"""
+    latency = Timings()
+    backend = FakeBackend()
+
+    sets = [[random.choice(images) for _ in range(monitors)] for _ in range(switches)]
+    start = perf_counter()
+    for paths in sets:
+        with latency.time("switch, legacy"):
+            legacy_join(parent, paths)
+            backend.set_spanned_image(parent + ".joined_file.jpg")
+    legacy = report(f"compose {monitors} monitors, legacy", len(sets), perf_counter() - start)
+
+    cache = ResizeCache(logger, parent, cache_mb * 1024 * 1024, 1000 * 1000000)
+    prerenderer = PreRenderer(logger, parent, cache, index.image_info)
+    prerenderer.set_layout(default_layout(monitors), ['zoom'] * monitors)
+    prerenderer.set_output(output_format, 95 if output_format == 'jpeg' else 6)
+
+    for label in ("cold", "warm"):
+        start = perf_counter()
+        for paths in sets:
+            with latency.time(f"switch, {label}"):
+                prerenderer.swap_in(paths)
+                backend.set_spanned_image(prerenderer.output_path)
+        report(f"compose {monitors} monitors, {label} cache", len(sets), perf_counter() - start, legacy)
+
+        # drops the resized images kept in memory, so warm runs use the disk cache
+        prerenderer.resized = {}
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scanning and joining wallpapers on generated images")
+    parser.add_argument("--images", type=int, nargs='+', default=[200, 2000],
+                        help="image counts to benchmark, each gets its own tree")
+    parser.add_argument("--folders", type=int, default=4, help="sub-folders the images are spread over")
+    parser.add_argument("--formats", nargs='+', default=['jpeg', 'png'], choices=list(IMAGE_FORMATS),
+                        help="formats of the generated images")
+    parser.add_argument("--junk", type=float, default=0.1, help="files that aren't images, as a fraction of the images")
+    parser.add_argument("--monitors", type=int, default=2, help="monitors to join images for")
+    parser.add_argument("--switches", type=int, default=20, help="joined images to build")
+    parser.add_argument("--sample", type=int, default=50, help="images to resize, hash and check one at a time")
+    parser.add_argument("--cache-mb", type=int, default=500, help="resize cache size, 0 turns it off")
+    parser.add_argument("--output-format", default='jpeg', choices=list(OUTPUT_FORMATS), help="format of the joined image")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated tree")
+    parser.add_argument("--keep", action="store_true", help="don't delete the generated trees")
+    args = parser.parse_args()
+
+    if args.folders < 1 or args.monitors < 1 or min(args.images) < 1:
+        sys.exit("--images, --folders and --monitors must be at least 1")
+
+    random.seed(args.seed)
+    for count in args.images:
+        parent = tempfile.mkdtemp(prefix="wall_paper_benchmark_") + "/"
+        try:
+            start = perf_counter()
+            junk = make_tree(parent, count, args.folders, args.formats, args.junk)
+            print(f"\n{count} images and {junk} junk files in {args.folders} folders, made in {perf_counter() - start:.1f}s ({parent})")
+
+            logger = ErrorLogger(parent)
+            folders = [os.path.join(parent, f"folder{folder}") for folder in range(args.folders)]
+
+            index, images = bench_scan(logger, parent, folders)
+            bench_validate(folders, args.sample)
+            bench_hash(images, args.sample)
+            resize = bench_resize(logger, images, (1920, 1080), args.sample)
+            compose = bench_compose(logger, parent, index, images, args.monitors, args.switches, args.cache_mb, args.output_format)
+
+            print("\nlatency")
+            for summary in (resize.summary(), compose.summary()):
+                print(format_summary(summary).split("\n", 2)[2])
+            logger.flush()
+        finally:
+            if not args.keep:
+                shutil.rmtree(parent, ignore_errors=True)
+
+    # every stage the switcher itself times, over all the runs
+    print("\nswitcher stages, all runs")
+    print(format_summary(timings.summary()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+@brief - keeps a persistent index of the image files in each wallpaper
+         folder, so re-reading the config file does not have to list every
+         folder again. A folder is only rescanned when its mtime changes,
+         which happens whenever a file is added, removed or renamed in it.
+
+         Files are checked by their contents rather than their extension.
+         Each one is opened just far enough to read its format and size,
+         on a thread pool, and the result is kept in the index so a file
+         is only checked again if it changes. The width and height are kept
+         too, so nothing later needs to open a file just to get its size.
+
+         A perceptual hash of each image is worked out on a background
+         thread and kept in the index as well, so resized copies of the
+         same picture can be found. Only new or changed files are hashed.
+"""
+
+
+import os  # to list folders and check their mtimes
+import json  # to read/write the index file
+import mmap  # to search files for end markers without reading them in
+import threading  # to hash images in the background
+from time import monotonic  # to save hashes every so often
+from concurrent.futures import ThreadPoolExecutor  # to check files in parallel
+from PIL import Image  # to read image headers
+
+
+# bump when the layout of the index file changes, older indexes are rebuilt
+INDEX_VERSION = 4
+
+# formats the wallpaper can be made from. cameras and phones save photos
+# with extra pictures in them as MPO, which is a jpeg with more appended
+VALID_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "GIF", "BMP", "TIFF"}
+JPEG_FORMATS = {"JPEG", "MPO"}
+
+# jpeg can be decoded at 1/8 scale, so down to 1/64 of its pixels
+JPEG_DRAFT_PIXELS = 64
+
+# files are checked on this many threads, they mostly wait on disk/network
+CHECK_THREADS = min(16, (os.cpu_count() or 1) * 4)
+
+# invalid files named in the summary logged for a folder, the rest are counted
+INVALID_SHOWN = 5
+
+# images are hashed this many at a time, results are handed back per batch
+HASH_BATCH = 16
+
+# hashing decodes the whole image for formats without draft decoding, so
+# it is kept to a couple of threads, leaving the rest of the CPU alone
+HASH_THREADS = min(2, os.cpu_count() or 1)
+
+# the index is written with new hashes at most this often, in seconds, as
+# a large library takes hours to hash and the whole file is written each time
+HASH_SAVE_INTERVAL = 300
+
+
+def png_complete(f) -> bool:
+    """ If the png file f reaches its IEND chunk. Only the chunk headers
+    are read, skipping over the data between them"""
+    f.seek(8) # signature
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return False
+        if header[4:] == b"IEND":
+            return True
+        # the chunk's data, then its crc
+        f.seek(int.from_bytes(header[:4], 'big') + 4, os.SEEK_CUR)
+
+
+def image_complete(path : str, image_format : str) -> bool:
+    """ If the jpeg or png at path has its end marker, ie, wasn't cut short
+    while copying. Data after the end marker, like the video in a motion
+    photo, is allowed. Other formats are always complete"""
+    if image_format == "PNG":
+        with open(path, 'rb') as f:
+            return png_complete(f)
+
+    if image_format not in JPEG_FORMATS:
+        return True
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # walk the segments to the main image's start of scan, skipping
+        # over APP segments, which can hold a whole thumbnail jpeg
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                return False
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1 # padding
+                continue
+            if marker == 0xDA:
+                break
+            pos += 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+        else:
+            return False
+
+        # scan data can't contain the end marker, jpeg escapes 0xFF bytes
+        return data.find(b"\xff\xd9", pos) != -1
+
+
+def check_image(path : str) -> dict:
+    """ Return the index entry for path. Valid images have a width and
+    height, anything else has an error instead. Reads the header and
+    searches for the end marker only, never decodes the image"""
+    stat = None
+    try:
+        stat = os.stat(path)
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+        with Image.open(path) as im:
+            image_format = im.format
+            entry['format'] = image_format
+            entry['width'], entry['height'] = im.size
+
+        if image_format not in VALID_FORMATS:
+            return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'error': f"unsupported format {image_format}"}
+
+        # jpeg and png have a fixed end marker, missing it means the file
+        # was cut short, and would fail part way through decoding later
+        if not image_complete(path, image_format):
+            entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'error': f"truncated {image_format}"}
+        return entry
+
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # files that aren't images keep their stat, so they aren't
+        # checked and logged again on every rescan
+        if stat is None:
+            return {'mtime': None, 'size': None, 'error': str(e) or type(e).__name__}
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'error': str(e) or type(e).__name__}
+
+
+def dhash(path : str, max_pixels : int) -> int:
+    """ Return the 64 bit difference hash of the image at path, one bit per
+    pair of neighbouring pixels on a 9x8 grey thumbnail, set if the left
+    one is darker. Resized or recompressed copies of an image hash to the
+    same or nearly the same value. Returns None if it can't be read, or
+    would decode to more than max_pixels"""
+    try:
+        with Image.open(path) as im:
+            # jpeg decodes straight to 1/8 scale, everything else is
+            # reduced by whole pixels before the final resize
+            im.draft('L', (9, 8))
+            if im.size[0] * im.size[1] > max_pixels:
+                return None
+            pixels = im.convert('L').resize((9, 8), Image.BILINEAR, reducing_gap=2.0).tobytes()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    value = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            value = (value << 1) | (pixels[col] < pixels[col + 1])
+    return value
+
+
+class ImageHasher():
+    """
+            Background thread that hashes images in batches. Results are
+            collected rather than written to the index, so only the thread
+            that owns the index ever changes it. Hashing can be paused, ie,
+            while the system is busy or on battery.
+
+            Class Members:
+                condition : threading.Condition - guards everything below
+                max_pixels : int - images that would decode larger are not hashed
+                paused : bool - if no new batches are started
+                inline : bool - if batches are hashed by finished on the calling thread instead, ie, when profiling
+                queue : list - (folder, name, mtime) waiting to be hashed
+                pending : set - everything queued or hashed, until its result is handed back
+                results : list - (folder, name, mtime, hash) that are done
+                worker : threading.Thread - started on the first submit
+    """
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.max_pixels = 100 * 1000000
+        self.paused = False
+        self.inline = False
+        self.queue = []
+        self.pending = set()
+        self.results = []
+        self.worker = None
+
+    def submit(self, items : list[tuple]):
+        """ Queue (folder, name, mtime) items to be hashed, skipping any
+        that are already on their way"""
+        with self.condition:
+            items = [item for item in dict.fromkeys(items) if item not in self.pending]
+            if not items:
+                return
+            self.pending.update(items)
+            self.queue += items
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+            self.condition.notify_all()
+
+    def set_paused(self, paused : bool):
+        """ Stop or carry on hashing, a batch already started finishes"""
+        with self.condition:
+            self.paused = paused
+            self.condition.notify_all()
+
+    def finished(self) -> list[tuple]:
+        """ Return and clear the (folder, name, mtime, hash) results so far.
+        Inline, one batch is hashed first"""
+        if self.inline and not self.paused:
+            with self.condition:
+                batch = self.queue[:HASH_BATCH]
+                del self.queue[:HASH_BATCH]
+            done = [item + (dhash(os.path.join(item[0], item[1]), self.max_pixels),) for item in batch]
+            with self.condition:
+                self.results += done
+
+        with self.condition:
+            results = self.results
+            self.results = []
+            self.pending.difference_update(result[:3] for result in results)
+        return results
+
+    def _work(self):
+        """ Worker thread, hashes a batch at a time on a thread pool"""
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as pool:
+            while True:
+                with self.condition:
+                    while not self.queue or self.paused or self.inline:
+                        self.condition.wait()
+                    batch = self.queue[:HASH_BATCH]
+                    del self.queue[:HASH_BATCH]
+                    max_pixels = self.max_pixels
+
+                hashes = pool.map(lambda path: dhash(path, max_pixels),
+                                  [os.path.join(folder, name) for folder, name, _ in batch])
+                done = [item + (value,) for item, value in zip(batch, hashes)]
+                with self.condition:
+                    self.results += done
+
+
+class ImageIndex():
+    """
+            Persistent map of folder -> files, stored as JSON next to the
+            config file.
+
+            Class Members:
+                logger : ErrorLogger - where invalid files are logged
+                path : str - the full path to the index file
+                folders : dict - folder -> {"mtime": int, "files": {name: entry}}, see check_image for entries
+                dirty : bool - if folders changed since the last save
+                last_save : float - monotonic time the index was last written
+                max_pixels : int - images that would decode larger can't be used
+                hasher : ImageHasher - fills in the "dhash" of entries in the background
+                hash_version : int - bumped whenever hashes are added, so lookups built from them can be redone
+    """
+
+    def __init__(self, logger, directory : str):
+
+        self.logger = logger
+        self.path = directory + ".image_index.json"
+        self.dirty = False
+        self.last_save = monotonic()
+        self.max_pixels = 100 * 1000000
+        self.hasher = ImageHasher()
+        self.hash_version = 0
+
+        # a missing, corrupt or old index just means every folder is rescanned
+        self.folders = {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.folders = data['folders']
+        except (OSError, ValueError, AttributeError, KeyError):
+            pass
+
+    def folder_images(self, folder : str) -> list[str]:
+        """ Return the full paths of all valid image files in folder,
+        rescanning it only if it changed since it was last indexed"""
+        mtime = os.stat(folder).st_mtime_ns
+        entry = self.folders.get(folder)
+
+        if entry is None or entry['mtime'] != mtime:
+            old_files = entry['files'] if entry is not None else {}
+            entry = {'mtime': mtime, 'files': self.scan(folder, old_files)}
+            self.folders[folder] = entry
+            self.dirty = True
+        self.hash_missing(folder, entry['files'])
+
+        return [os.path.join(folder, name) for name, info in entry['files'].items() if 'error' not in info]
+
+    def scan(self, folder : str, old_files : dict) -> dict:
+        """ List folder and return name -> entry for every file in it.
+        Entries in old_files are reused if the file hasn't changed"""
+        files = {}
+        to_check = []
+        for f in os.scandir(folder):
+            old = old_files.get(f.name)
+            try:
+                stat = f.stat()
+                if old is not None and old['mtime'] == stat.st_mtime_ns and old['size'] == stat.st_size:
+                    files[f.name] = old
+                    continue
+            except OSError:
+                pass
+            to_check.append(f.name)
+
+        files.update(self.check_files(folder, to_check))
+        return files
+
+    def check_files(self, folder : str, names : list[str]) -> dict:
+        """ Check the files in folder in parallel, logging a summary of the
+        invalid ones. Returns name -> entry"""
+        if not names:
+            return {}
+
+        paths = [os.path.join(folder, name) for name in names]
+        with ThreadPoolExecutor(max_workers=CHECK_THREADS) as pool:
+            entries = dict(zip(names, pool.map(check_image, paths)))
+
+        # a folder of non-images is one line, each file is only logged at debug
+        invalid = [name for name, entry in entries.items() if 'error' in entry]
+        for name in invalid:
+            self.logger.log(f"Invalid image file: {os.path.join(folder, name)} ({entries[name]['error']})", 'debug')
+        if invalid:
+            more = f" and {len(invalid) - INVALID_SHOWN} more" if len(invalid) > INVALID_SHOWN else ""
+            self.logger.log(f"ERROR: {len(invalid)} invalid image file(s) in '{folder}': {', '.join(invalid[:INVALID_SHOWN])}{more}")
+        return entries
+
+    def usable(self, info : dict) -> bool:
+        """ If the index entry info is a valid image that can be decoded
+        within max_pixels. jpegs are decoded at a reduced size first"""
+        if 'error' in info:
+            return False
+        pixels = info['width'] * info['height']
+        if info['format'] in JPEG_FORMATS:
+            pixels //= JPEG_DRAFT_PIXELS
+        return pixels <= self.max_pixels
+
+    def has_images(self, folder : str) -> bool:
+        """ If folder is indexed and has at least one usable image"""
+        entry = self.folders.get(folder)
+        return entry is not None and any(self.usable(info) for info in entry['files'].values())
+
+    def image_info(self, path : str) -> dict:
+        """ Return the index entry for path, with its width and height,
+        or None if it isn't indexed"""
+        entry = self.folders.get(os.path.dirname(path))
+        if entry is None:
+            return None
+        return entry['files'].get(os.path.basename(path))
+
+    def update_folder(self, folder : str, added : list[str], removed : list[str]) -> list[str]:
+        """ Apply a change seen by the folder watcher, given full paths,
+        so the folder does not need to be rescanned. Returns the added
+        paths that are valid images"""
+        entry = self.folders.get(folder)
+        if entry is None:
+            return []
+
+        for path in removed:
+            entry['files'].pop(os.path.basename(path), None)
+
+        checked = self.check_files(folder, [os.path.basename(path) for path in added])
+        entry['files'].update(checked)
+        self.hash_missing(folder, checked)
+        try:
+            entry['mtime'] = os.stat(folder).st_mtime_ns
+        except OSError:
+            entry['mtime'] = None
+        self.dirty = True
+
+        return [os.path.join(folder, name) for name, info in checked.items() if 'error' not in info]
+
+    def hash_missing(self, folder : str, files : dict):
+        """ Queue the valid images among files in folder that have not been
+        hashed yet. Also picks up files in progress from a previous run"""
+        self.hasher.submit([(folder, name, info['mtime']) for name, info in files.items()
+                            if 'error' not in info and 'dhash' not in info])
+
+    def apply_hashes(self) -> bool:
+        """ Add the hashes finished in the background to their entries.
+        Hashes of files that changed since they were queued are dropped.
+        Returns True if any were added"""
+        added = False
+        for folder, name, mtime, value in self.hasher.finished():
+            info = self.folders.get(folder, {'files': {}})['files'].get(name)
+            if info is not None and info['mtime'] == mtime:
+                # None means it could not be hashed, so it isn't tried again
+                info['dhash'] = value
+                added = True
+
+        if added:
+            self.hash_version += 1
+            self.dirty = True
+        return added
+
+    def save_hashes(self):
+        """ Write the index to disk if anything changed, and it has been
+        HASH_SAVE_INTERVAL seconds since it was last written"""
+        if monotonic() - self.last_save >= HASH_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """ Write the index to disk if anything changed"""
+        if not self.dirty:
+            return
+        self.last_save = monotonic()
+
+        # write to a temp file first so a crash never leaves half an index
+        temp = self.path + ".tmp"
+        with open(temp, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'folders': self.folders}, f)
+        os.replace(temp, self.path)
+        self.dirty = False
@@ -8,56 +8,161 @@
         It also allows for setting different wallpapers to each monitor, such
         as space images on the left screen, and landscapes on the right. Again, 
         provided both folders are in the same parent directory
-         - note, this relies on hydrapaper being installed
+         - note, this relies on hydrapaper being installed, or on the
+           compositor service which joins and spans the images itself,
+           for any number of monitors
          
 @version - 2.0, using classes to mainstream the code, and starting
            to use JSON as a config file instead of a plain text file.
-           Note, a few things in the config file don't do anything yet, 
-           such as gsettings_mode. Currently only uses zoom (span for hydrapaper)
-           will make functionl in v3
-           
+           Note, gsettings_mode sets the picture option for the gsettings
+           service. Hydrapaper and the compositor span one joined image, and
+           fit each wallpaper to its monitor with fit_mode instead
+
 """
 
 
-import os  # to delete old log file, and execute shell commands
-from time import sleep  # to pause between switches
-from random import shuffle # shuffle pictures to randomize display order
+import os  # to check the config file and image folders exist
 from datetime import datetime # to display in the log file the time last executed
 import json # to read/write the config file
-from PIL import Image # used to join pictures together manually
+import atexit # to write out the rest of the log when the program stops
+import signal # to stop cleanly when the session ends
+import sys # to exit from the signal handler
+import argparse # for --stats and --profile
+import threading # the log is written to from background threads
+from time import monotonic # to keep waiting after a config change
+from render import PreRenderer, ResizeCache, FIT_MODES, OUTPUT_FORMATS # builds the joined image in the background
+from image_index import ImageIndex # remembers folder contents between config reloads
+from watcher import FolderWatcher, ConfigWatcher # notices images/config changing while running
+from backends import create_backend # sets the wallpaper, in-process where possible
+from monitors import detect_layout, default_layout # where each monitor is, for the joined image
+from scheduler import Scheduler, stagger_timing # when each monitor changes, without drift
+from selector import ImageSelector # picks images without repeats, carrying on after restarts
+from stats import timings, format_summary # how long each stage of a switch takes
+from policy import PowerPolicy, CHECK_INTERVAL # holds back switching when the screen is off or the system is busy
 
 
 class ErrorLogger():
     """
-            Create a log file for errors or blank out the old one
-            Allows easy writing to the end of the file for logging errors
+            Append to the log file for errors, keeping the logs of earlier
+            runs. Lines are buffered and written out together, and the file
+            is rotated to errors.log.1, .2, ... once it gets too large
             
             Class Members:
                 path : str - the full path to the log file
+                level : str - the lowest level that is written, see levels
+                lock : threading.Lock - guards everything below
+                buffer : list - lines waiting to be written
+                last_flush : float - monotonic time the buffer was last written
+                last_message : str - the last message logged, to spot repeats
+                repeats : int - how many times last_message was logged again
     """
+    
+    # the level of a message comes from its prefix, unless given
+    levels = {'debug': 0, 'info': 1, 'error': 2, 'critical': 3}
+    
+    # the log is rotated past this size, keeping this many old logs
+    max_bytes = 1024 * 1024
+    backups = 3
+    
+    # buffered lines are written once there are this many, or they are this old
+    flush_lines = 100
+    flush_seconds = 5
+    
     def __init__(self, directory : str):
         
         # determine the full file path for the log file
         self.path = directory + "errors.log"
+        self.level = 'info'
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = monotonic()
+        self.last_message = None
+        self.repeats = 0
         
-        # overwrite old-log, or create a 
-        # blank log file if it doesn't exist
-        with open(self.path, 'w') as f:
-            # write the datetime at the top for reference
-            formatted_time = "Ran On: " + self.time_str()
-            f.write(formatted_time + "\n")
-            [f.write('-') for i in range(len(formatted_time))]
-            f.write('\n\n')
-  
+        # write the datetime at the top of this run for reference
+        formatted_time = "Ran On: " + self.time_str()
+        self.buffer.append("\n" + formatted_time + "\n" + "-" * len(formatted_time) + "\n")
+        self.flush()
+        
+        # nothing logged is lost when the program stops
+        atexit.register(self.flush)
+        
+    def log(self, log_message: str, level : str = None):
+        """ Log the message, at level if given, otherwise 'critical' or
+        'error' if it starts with CRITICAL or ERROR, and 'info' if not.
+        The same message repeated is only written once, with a count"""
+        if level is None:
+            if log_message.startswith("CRITICAL"):
+                level = 'critical'
+            elif log_message.startswith("ERROR"):
+                level = 'error'
+            else:
+                level = 'info'
+        if self.levels[level] < self.levels[self.level]:
+            return
         
-    def log(self, log_message: str):
-        with open(self.path, 'a') as f:
-            f.write(log_message + "\n")
+        with self.lock:
+            if log_message == self.last_message:
+                self.repeats += 1
+                return
+            self.end_repeats()
+            self.last_message = log_message
+            
+            # blank lines before a message go before its time too
+            message = log_message.lstrip("\n")
+            self.buffer.append("\n" * (len(log_message) - len(message)) + datetime.now().strftime("%H:%M:%S ") + message)
+            
+            if len(self.buffer) >= self.flush_lines or monotonic() - self.last_flush >= self.flush_seconds:
+                self.write()
+    
+    def end_repeats(self):
+        """ Note how many times the last message was repeated, if it was.
+        Called with the lock held"""
+        if self.repeats:
+            self.buffer.append(f"{datetime.now().strftime('%H:%M:%S ')}(last message repeated {self.repeats} more time(s))")
+            self.repeats = 0
+            
+    def flush(self):
+        """ Write out everything logged so far, ie, before sleeping"""
+        with self.lock:
+            self.end_repeats()
+            self.last_message = None
+            self.write()
+    
+    def write(self):
+        """ Append the buffer to the log file, rotating it first if it is
+        too large. Called with the lock held"""
+        self.last_flush = monotonic()
+        if not self.buffer:
+            return
+        
+        try:
+            if os.path.isfile(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.isfile(f"{self.path}.{i}"):
+                        os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                os.replace(self.path, self.path + ".1")
+            
+            with open(self.path, 'a') as f:
+                f.write("\n".join(self.buffer) + "\n")
+        except OSError:
+            pass # nowhere left to report it
+        self.buffer = []
             
     def time_str(self) -> str:
         return datetime.now().strftime("%a %b %d @ %-I:%M:%S %p")
                     
 class ConfigReader():
+    
+    # fields that need the display loop restarted when changed, the rest
+    # are read every switch and take effect without a restart
+    restart_fields = {'service', 'gsettings_mode', 'gnome_color_theme', 'hydrapaper_stagger',
+                      'switch_time', 'monitor_timing', 'desktop_backend', 'monitor_layout', 'fit_mode',
+                      'image_parent_directory', 'image_folders'}
+    
+    # fields the image lists are built from
+    folder_fields = {'service', 'image_parent_directory', 'image_folders'}
+    
     def __init__(self, logger : ErrorLogger, directory : str):
         
         # determine the full file path for the config file
@@ -67,51 +172,98 @@ class ConfigReader():
         if (not os.path.isfile(self.path)):
             self.create_default_config_file()
             
-        # track last time config file modified
-        self.last_modified = os.stat(self.path).st_ctime
+        # wakes up waits as soon as the config file is saved
+        self.config_watcher = ConfigWatcher(self.path)
             
         # var to track config data, to be filled in validate
-        # config
+        # config. raw data is the file as read, to compare on reload
         self.config_data = None 
+        self.raw_data = None
             
         # validate the data to make sure they have good values.
         self.critical_error = False
         self.logger = logger
+        
+        # folder contents from previous runs, so only changed folders are rescanned
+        self.index = ImageIndex(logger, directory)
+        atexit.register(self.index.save)
+        
+        # image list name -> the folders it picks from, and the watcher over
+        # those folders. both are set up in validate config, the images in
+        # them are only kept in the index
+        self.pool_folders = {}
+        self.watcher = None
         self.validate_config()
     
+    def wait(self, seconds : float) -> bool:
+        """ Sleep for seconds, returning early with True if the config file
+        is changed in the meantime"""
+        # the log is up to date while nothing is happening
+        self.logger.flush()
+        return self.config_watcher.wait(seconds)
+    
     def check_config_updated(self) -> bool:
-        modified = os.stat(self.path).st_ctime
-        if self.last_modified != modified:
-            self.last_modified = modified
-            self.logger.log(f"\nConfig File Updated - {self.logger.time_str()}")
-            
-            # update all the config variables
-            self.critical_error = False # assume no error until read
-            self.validate_config()
-            return True # was updated
-        else:
+        """ Reload the config file if it was changed. Returns True if the
+        display loop needs to restart, ie, the service or folders changed.
+        Other fields are updated in place and return False"""
+        if not self.config_watcher.consume():
             return False # was not updated
+        
+        try:
+            with open(self.path, 'r') as file:
+                raw_data = json.load(file)
+        except ValueError:
+            # likely mid-save, another change event will follow
+            self.logger.log("ERROR: config file is not valid JSON, keeping the current config")
+            return False
+        
+        # saved without changes
+        if raw_data == self.raw_data:
+            return False
+        
+        self.logger.log(f"\nConfig File Updated - {self.logger.time_str()}")
+        previous = self.raw_data or {}
+        changed = {field for field in set(raw_data) | set(previous) if raw_data.get(field) != previous.get(field)}
+        
+        # update all the config variables, only rescanning folders if
+        # the fields they come from changed
+        was_critical = self.critical_error
+        self.critical_error = False # assume no error until read
+        self.validate_config(keep_folders = not was_critical and not (changed & self.folder_fields))
+        
+        return was_critical or self.critical_error or bool(changed & self.restart_fields)
             
 
         
-    def validate_config(self):
+    def validate_config(self, keep_folders : bool = False):
         """ 
             Check the config data to make sure they are allowed values
             ie, bools are true false, ints dont contain strings, etc.
             
             If errors are found, they will be logged. If possible, 
             default values will be assigned
+            
+            If keep_folders, the image lists from the last validate are
+            kept as they are instead of being rebuilt
         """
+        # folders may have changed, so stop watching the old ones
+        if not keep_folders:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+            self.pool_folders = {}
+        
         # read in all the data
         with open(self.path, 'r') as file:
             self.config_data = json.load(file)
+        self.raw_data = json.loads(json.dumps(self.config_data))
         
         # check the service, this is a critical check
         service = None
         try:
             service = self.config_data['service']
-            if (service != 'gsettings' and service != 'hydrapaper'):
-                self.logger.log("CRITICAL ERROR: 'service' should be either 'gsettings' or 'hydrapaper'")
+            if (service not in ['gsettings', 'hydrapaper', 'compositor']):
+                self.logger.log("CRITICAL ERROR: 'service' should be either 'gsettings', 'hydrapaper' or 'compositor'")
                 self.critical_error = True
         except KeyError:
             self.critical_error = True
@@ -125,7 +277,7 @@ class ConfigReader():
             # check color theme - non-critical, default 'dark'
             try:
                 if (self.config_data['gnome_color_theme'] == 'light'):
-                    self.config_data['gnome_color_theme'] == "picture-uri"
+                    self.config_data['gnome_color_theme'] = "picture-uri"
                 elif (self.config_data['gnome_color_theme'] == 'dark'):
                     self.config_data['gnome_color_theme'] = "picture-uri-dark"
                 else:
@@ -154,8 +306,8 @@ class ConfigReader():
                 self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
                 self.config_data['gsettings_mode'] = 'zoom'
         
-        # check hydrapaper-specific config stuff
-        elif (service == 'hydrapaper'):
+        # check hydrapaper/compositor-specific config stuff
+        elif (service == 'hydrapaper' or service == 'compositor'):
             
             # hydrapaper_stagger - validate and make a bool
             try:
@@ -199,6 +351,38 @@ class ConfigReader():
             self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
             self.config_data['switch_time'] = 60
             
+        # check log level - noncritical, default 'info'
+        self.config_data['log_level'] = self.validate_choice('log_level', ['debug', 'info'], 'info')
+        self.logger.level = self.config_data['log_level']
+            
+        # check when to hold back switching - noncritical
+        self.config_data['policy_source'] = self.validate_choice('policy_source', ['auto', 'stub', 'off'], 'auto')
+        self.config_data['pause_when_locked'] = self.validate_choice('pause_when_locked', ['true', 'false'], 'true') == 'true'
+        self.config_data['battery_stretch'] = self.validate_int('battery_stretch', 2, 1)
+        self.config_data['max_load_percent'] = self.validate_int('max_load_percent', 100, 0)
+            
+        # check desktop backend - noncritical, default 'auto'
+        self.config_data['desktop_backend'] = self.validate_choice('desktop_backend', ['auto', 'gio', 'subprocess', 'fake'], 'auto')
+            
+        # check resize cache budget - noncritical, default 500 MB
+        self.config_data['resize_cache_mb'] = self.validate_int('resize_cache_mb', 500, 0)
+        
+        # check decode memory ceiling - noncritical, default 100 megapixels
+        self.config_data['max_decode_megapixels'] = self.validate_int('max_decode_megapixels', 100, 1)
+        self.index.max_pixels = self.config_data['max_decode_megapixels'] * 1000000
+        self.index.hasher.max_pixels = self.index.max_pixels
+        
+        # check joined image format - noncritical, default jpeg at quality 95
+        output_format = self.validate_choice('output_format', list(OUTPUT_FORMATS), 'jpeg')
+        self.config_data['output_format'] = output_format
+        if (output_format == 'jpeg'):
+            quality = min(self.validate_int('output_quality', 95, 1), 100)
+        elif (output_format == 'png'):
+            # png is lossless, the quality is its compression level
+            quality = min(self.validate_int('output_quality', 6, 0), 9)
+        else:
+            quality = 0
+        self.config_data['output_quality'] = quality
             
         # check parent directory - critical
         parent_path = None
@@ -215,17 +399,19 @@ class ConfigReader():
             
         # check child directories and validate files within,
         # here, check only they were in json, check files in different function
-        if (not self.critical_error):
+        # the same folders (and watcher) the display loop is already using
+        # are kept as they are
+        if (not keep_folders and not self.critical_error):
             try:
                 image_folders = self.config_data['image_folders']
                 
                 # validate single image folder
                 if (service == 'gsettings'):
                     try:
-                        self.config_data['image_folders']['one_monitor'] = self.validate_img_folders(image_folders['one_monitor'])
+                        self.validate_img_folders(image_folders['one_monitor'], 'one_monitor')
                         
                         # check at least one valid image file
-                        if not self.config_data['image_folders']['one_monitor']:
+                        if not self.pool_has_images('one_monitor'):
                             self.logger.log("CRITICAL ERROR: no valid images in one monitor folders")
                             self.critical_error = True
                     # single image field doesn't exist
@@ -235,17 +421,16 @@ class ConfigReader():
                         self.critical_error = True
                         
                 # validate left/right monitor folders if hydrapaper
-                else:
+                elif (service == 'hydrapaper'):
                     try:
-                        # turn into list of image file paths
-                        self.config_data['image_folders']['left_monitor'] = self.validate_img_folders(image_folders['left_monitor'])
-                        self.config_data['image_folders']['right_monitor'] = self.validate_img_folders(image_folders['right_monitor'])
+                        self.validate_img_folders(image_folders['left_monitor'], 'left_monitor')
+                        self.validate_img_folders(image_folders['right_monitor'], 'right_monitor')
                         
                         # check that at least one valid image for each monitor to display
-                        if not self.config_data['image_folders']['left_monitor']:
+                        if not self.pool_has_images('left_monitor'):
                             self.logger.log("CRITICAL ERROR: no valid images in left monitor folders")
                             self.critical_error = True
-                        if not self.config_data['image_folders']['right_monitor']:
+                        if not self.pool_has_images('right_monitor'):
                             self.logger.log("CRITICAL ERROR: no valid images in right monitor folders")
                             self.critical_error = True
                         
@@ -253,6 +438,29 @@ class ConfigReader():
                         self.logger.log("CRITICAL ERROR: 'left_monitor' or 'right_monitor' list(s) missing")
                         self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
                         self.critical_error = True
+                
+                # validate a folder list per monitor if compositor
+                else:
+                    try:
+                        folder_lists = image_folders['monitors']
+                        if (not isinstance(folder_lists, list) or not folder_lists or
+                            not all(isinstance(folders, list) for folders in folder_lists)):
+                            self.logger.log("CRITICAL ERROR: 'monitors' should be a list of folder lists, one per monitor")
+                            self.critical_error = True
+                        else:
+                            for i, folders in enumerate(folder_lists):
+                                self.validate_img_folders(folders, f"monitors[{i}]")
+                            
+                            # check that at least one valid image for each monitor to display
+                            for i in range(len(folder_lists)):
+                                if not self.pool_has_images(f"monitors[{i}]"):
+                                    self.logger.log(f"CRITICAL ERROR: no valid images in monitor {i + 1} folders")
+                                    self.critical_error = True
+                    
+                    except KeyError:
+                        self.logger.log("CRITICAL ERROR: 'monitors' list is missing")
+                        self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+                        self.critical_error = True
                         
                         
             # image folder sub-dictionary doesn't exist.
@@ -260,15 +468,216 @@ class ConfigReader():
                 self.critical_error = True
                 self.logger.log("CRITICAL ERROR: 'image_folders' sub dictionary is missing")
                 self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+        
+        # how often each folder is picked from
+        if (not self.critical_error):
+            self.config_data['folder_weights'] = self.validate_folder_weights()
+        
+        # match up image lists with the monitors they are shown on
+        if (not self.critical_error and service != 'gsettings'):
+            self.validate_monitor_layout(service)
+            self.config_data['fit_mode'] = self.validate_fit_mode(len(self.config_data['monitor_folders']))
+        
+        # when each monitor changes
+        if (not self.critical_error):
+            if (service == 'gsettings'):
+                self.config_data['monitor_timing'] = self.validate_monitor_timing(1, False)
+            else:
+                self.config_data['monitor_timing'] = self.validate_monitor_timing(len(self.config_data['monitor_folders']),
+                                                                                  self.config_data['hydrapaper_stagger'])
+        
+        # watch the folders so images added or removed are picked up
+        if (not self.critical_error and not keep_folders):
+            self.watch_folders()
                                 
                 
-    def validate_img_folders(self, folders: list[str]) -> list[str]:
-        """ Given a list of sub-folders, return a list of all valid 
-        image files within each sub-folder. If no valid image folders, returns empty list"""
-        # track valid sub-folders with at least 1 image file
-        valid_files = []
+    def validate_monitor_layout(self, service : str):
+        """ Set 'monitor_layout' to the list of monitors from the config, or
+        found with xrandr if it is 'auto', and 'monitor_folders' to the
+        folders each of those monitors picks from. Falls back to 1920x1080 monitors
+        side by side if the layout can't be used"""
+        try:
+            value = self.config_data['monitor_layout']
+        except KeyError:
+            self.logger.log("ERROR: 'monitor_layout' field is missing")
+            self.logger.log("Using default 'auto'")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            value = 'auto'
+        
+        layout = []
+        if (value == 'auto'):
+            layout = detect_layout(self.logger)
+            if not layout:
+                self.logger.log("ERROR: could not detect the monitor layout")
+                self.logger.log("Using 1920x1080 monitors side by side")
+        else:
+            try:
+                for monitor in value:
+                    layout.append({'x': int(monitor['x']), 'y': int(monitor['y']),
+                                   'width': int(monitor['width']), 'height': int(monitor['height']),
+                                   'scale': float(monitor.get('scale', 1))})
+                    if (layout[-1]['width'] < 1 or layout[-1]['height'] < 1 or layout[-1]['scale'] <= 0):
+                        raise ValueError
+                if not layout:
+                    raise ValueError
+            
+            # not a list of dicts, or a monitor is missing a field
+            except (ValueError, TypeError, KeyError, AttributeError):
+                self.logger.log("ERROR: 'monitor_layout' should be 'auto' or a list of monitors with x, y, width, height and scale")
+                self.logger.log("Using 1920x1080 monitors side by side")
+                layout = []
+        
+        if (service == 'hydrapaper'):
+            names = ['left_monitor', 'right_monitor']
+            if (layout and len(layout) != 2):
+                self.logger.log(f"ERROR: hydrapaper needs 2 monitors, the layout has {len(layout)}")
+                self.logger.log("Using 1920x1080 monitors side by side")
+                layout = []
+        else:
+            names = [f"monitors[{i}]" for i in range(len(self.config_data['image_folders']['monitors']))]
+            if (layout and len(names) > len(layout)):
+                self.logger.log(f"ERROR: {len(names)} monitor folder lists, but only {len(layout)} monitors. Extra lists are not used")
+        
+        if not layout:
+            layout = default_layout(len(names))
+        
+        # monitors without a list of their own reuse them from the start
+        self.config_data['monitor_layout'] = layout
+        self.config_data['monitor_folders'] = [self.pool_folders[names[i % len(names)]] for i in range(len(layout))]
+                
+    def validate_folder_weights(self) -> dict:
+        """ Return full folder path -> weight from 'folder_weights', which is
+        keyed by sub-folder like 'image_folders'. Folders that aren't listed
+        have a weight of 1"""
+        try:
+            value = self.config_data['folder_weights']
+        except KeyError:
+            self.logger.log("ERROR: 'folder_weights' field is missing")
+            self.logger.log("Using default {}")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            return {}
+        
+        try:
+            weights = {}
+            for folder, weight in value.items():
+                weight = float(weight)
+                if (weight < 0):
+                    raise ValueError
+                weights[os.path.expanduser(os.path.join(self.config_data['image_parent_directory'], folder))] = weight
+            return weights
+        
+        # not a dict, or a weight isn't a number
+        except (ValueError, TypeError, AttributeError):
+            self.logger.log("ERROR: 'folder_weights' should be a dictionary of sub-folder -> weight, at least 0")
+            self.logger.log("Using default {}")
+            return {}
+    
+    def validate_fit_mode(self, count : int) -> list[str]:
+        """ Return the fit mode for each of count monitors. 'auto' uses the
+        closest match to 'gsettings_mode', otherwise it is one mode for all
+        monitors, or a list of one per monitor, reused from the start"""
+        # gsettings_mode is only validated for gsettings, so anything it
+        # doesn't match just zooms like before
+        closest = {'zoom': 'zoom', 'scaled': 'fit', 'centered': 'center', 'stretched': 'stretch'}
+        auto = [closest.get(self.config_data.get('gsettings_mode'), 'zoom')] * count
         
-        valid_file_extensions = [".webp", ".svg", ".png", ".jpeg", ".jpg"]
+        try:
+            value = self.config_data['fit_mode']
+        except KeyError:
+            self.logger.log("ERROR: 'fit_mode' field is missing")
+            self.logger.log("Using default 'auto'")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            return auto
+        
+        if (value == 'auto'):
+            return auto
+        if (value in FIT_MODES):
+            return [value] * count
+        if (isinstance(value, list) and value and all(fit in FIT_MODES for fit in value)):
+            return [value[i % len(value)] for i in range(count)]
+        
+        self.logger.log(f"ERROR: 'fit_mode' should be 'auto', one of {FIT_MODES}, or a list of them for each monitor")
+        self.logger.log("Using default 'auto'")
+        return auto
+    
+    def validate_monitor_timing(self, count : int, stagger : bool) -> list[tuple]:
+        """ Return (interval, offset) in seconds for each of count monitors.
+        'auto' changes every monitor every 'switch_time', spread out if
+        stagger. Otherwise it is a list with an interval and offset per
+        monitor, reused from the start if there are more monitors"""
+        auto = stagger_timing(count, self.config_data['switch_time'], stagger)
+        try:
+            value = self.config_data['monitor_timing']
+        except KeyError:
+            self.logger.log("ERROR: 'monitor_timing' field is missing")
+            self.logger.log("Using default 'auto'")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            return auto
+        
+        if (value == 'auto'):
+            return auto
+        
+        try:
+            timing = []
+            for monitor in value:
+                interval = int(monitor['interval'])
+                offset = int(monitor.get('offset', interval))
+                if (interval < 5 or offset < 0):
+                    raise ValueError
+                timing.append((interval, offset))
+            if not timing:
+                raise ValueError
+            return [timing[i % len(timing)] for i in range(count)]
+        
+        # not a list of dicts, or a monitor is missing its interval
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.logger.log("ERROR: 'monitor_timing' should be 'auto' or a list with an 'interval' (at least 5) and 'offset' for each monitor")
+            self.logger.log("Using default 'auto'")
+            return auto
+                
+    def validate_int(self, field : str, default : int, minimum : int) -> int:
+        """ Return the config field as an int of at least minimum. Logs an
+        error and returns default if it is missing or not an integer"""
+        try:
+            value = int(self.config_data[field])
+            if (value < minimum):
+                self.logger.log(f"ERROR: '{field}' must be a minimum of {minimum}")
+                self.logger.log(f"Using minimum {minimum}")
+                value = minimum
+            return value
+        
+        except ValueError:
+            self.logger.log(f"ERROR: '{field}' should be a integer, at least {minimum}. ")
+            self.logger.log(f"Using default {default}")
+            return default
+        except KeyError:
+            self.logger.log(f"ERROR: '{field}' field is missing")
+            self.logger.log(f"Using default {default}")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            return default
+                
+    def validate_choice(self, field : str, acceptable_values : list[str], default : str) -> str:
+        """ Return the config field if it is one of acceptable_values. Logs
+        an error and returns default if it is missing or not acceptable"""
+        try:
+            value = self.config_data[field]
+            if (value not in acceptable_values):
+                self.logger.log(f"ERROR: '{field}' should be one of the following: {acceptable_values}")
+                self.logger.log(f"Using default '{default}'")
+                value = default
+            return value
+        
+        except KeyError:
+            self.logger.log(f"ERROR: '{field}' field is missing")
+            self.logger.log(f"Using default '{default}'")
+            self.logger.log("To make a new config file, delete the existing one\nand a default one will be automatically generated")
+            return default
+                
+    def validate_img_folders(self, folders: list[str], pool : str) -> list[str]:
+        """ Given a list of sub-folders, index the image files within each
+        sub-folder, and return the full paths of the ones that exist.
+        They are remembered under pool, to be watched for changes"""
+        self.pool_folders[pool] = []
         
         folders = [os.path.join(self.config_data['image_parent_directory'], f) for f in folders]
         for folder in folders:
@@ -276,16 +685,59 @@ class ConfigReader():
             if not os.path.isdir(folder):
                 self.logger.log(f"ERROR invalid folder path '{folder}'")
                 continue
+            self.pool_folders[pool].append(folder)
             
-            files = [f.path for f in list(os.scandir(folder))]
+            # only rescanned if the folder changed since last indexed
+            with timings.time("scan"):
+                self.index.folder_images(folder)
+        
+        self.index.save()
+        return self.pool_folders[pool]
+    
+    def pool_has_images(self, pool : str) -> bool:
+        """ If any folder of the image list pool has a valid image"""
+        return any(self.index.has_images(folder) for folder in self.pool_folders.get(pool, []))
+    
+    def watch_folders(self):
+        """ Start watching every folder used by an image list"""
+        folders = {folder for pool in self.pool_folders.values() for folder in pool}
+        known = {folder: self.index.folders[folder]['files'] for folder in folders}
+        self.watcher = FolderWatcher(known)
+    
+    def apply_folder_changes(self) -> bool:
+        """ Add/remove images the watcher saw change to the index, where
+        the display loops pick images from. Returns True if any folder
+        changed"""
+        if self.watcher is None:
+            return False
+        
+        # hashes finished in the background, only the index changes. they
+        # are written out every so often, and when the switcher stops
+        if self.index.apply_hashes():
+            self.index.save_hashes()
+        
+        changes = self.watcher.pending_changes()
+        for folder, added, removed in changes:
+            # only images that pass the index's checks are added, and
+            # the index is kept in step, so a reload doesn't need to rescan
+            added = self.index.update_folder(folder, added, removed)
             
-            for file in files:
-                if any(file.lower().endswith(ext) for ext in valid_file_extensions):
-                    valid_files.append(file)
-                else:
-                    self.logger.log(f"ERROR: Invalid image file: {file}")
-                    
-        return valid_files
+            self.logger.log(f"Folder changed '{folder}': {len(added)} added, {len(removed)} removed")
+        
+        if not changes:
+            return False
+        self.index.save()
+        
+        # a list emptied by deleting images can't be displayed from. it is
+        # allowed to recover if images are added back
+        empty = [pool for pool in self.pool_folders if not self.pool_has_images(pool)]
+        if empty:
+            if not self.critical_error:
+                self.logger.log(f"CRITICAL ERROR: no valid images left in {empty}")
+            self.critical_error = True
+        else:
+            self.critical_error = False
+        return True
  
                         
     def create_default_config_file(self):
@@ -300,6 +752,25 @@ class ConfigReader():
     "hydrapaper_stagger" : "true",
 
     "switch_time" : "60",
+    "monitor_timing" : "auto",
+
+    "log_level" : "info",
+
+    "policy_source" : "auto",
+    "pause_when_locked" : "true",
+    "battery_stretch" : "2",
+    "max_load_percent" : "100",
+
+    "desktop_backend" : "auto",
+    "monitor_layout" : "auto",
+    "fit_mode" : "auto",
+
+    "resize_cache_mb" : "500",
+    "max_decode_megapixels" : "100",
+    "output_format" : "jpeg",
+    "output_quality" : "95",
+
+    "folder_weights" : {},
 
     "image_parent_directory" : "/usr/share/backgrounds/",
     "image_folders" : 
@@ -318,12 +789,22 @@ class ConfigReader():
             [
                 "folder1", "folder2"
             ]
+        ,
+        "monitors" :
+            [
+                ["folder1"], ["folder2"]
+            ]
     }
 
 }"""
             f.write(contents)      
         
 class WallPaperSwitcher():
+    
+    # sets of images tried in a row when joining fails, before the switch
+    # is skipped until the next one is due
+    join_attempts = 3
+    
     def __init__(self):
         
         self.directory = __file__
@@ -336,128 +817,293 @@ class WallPaperSwitcher():
         # get config file info
         self.config = ConfigReader(self.logger, self.directory)
         self.keyboard_interupt = False
+
+        # what sets the wallpaper, made when a display loop starts, and the
+        # 'desktop_backend' value it was made for, 'auto' picks a backend
+        # with a different name
+        self.backend = None
+        self.backend_name = None
+        
+        # builds the joined image for the next switch while sleeping,
+        # using resized copies cached on disk where possible. the cache
+        # limits are set from the config when the hydrapaper loop starts
+        cache = ResizeCache(self.logger, self.directory, 0, 0)
+        self.prerenderer = PreRenderer(self.logger, self.directory, cache, self.config.index.image_info)
+        
+        # which image comes next, remembered across restarts
+        self.selector = ImageSelector(self.logger, self.directory, self.config.index)
+        
+        # timings of each stage, for --stats
+        self.stats_path = self.directory + ".stats.json"
+        
+        # whether the screen is off, on battery, or the system is busy
+        self.policy = PowerPolicy(self.logger, self.directory)
+        
+    def wait_for_switch(self, scheduler : Scheduler) -> bool:
+        """ Sleep until the scheduler's next deadline. Saving the config file
+        wakes this up right away, returning True if the display loop needs
+        to restart. Changes that don't need a restart are applied and the
+        wait carries on. While the policy has switching paused, the wait
+        carries on too, and the schedule is pushed back by the pause"""
+        timings.save(self.stats_path)
+        while True:
+            while self.config.wait(max(0, scheduler.next_deadline() - monotonic())):
+                if self.reload_config():
+                    return True
+            
+            state = self.check_policy()
+            scheduler.stretch = state['stretch']
+            if not state['paused']:
+                return False
+            
+            # nobody can see the wallpaper, so nothing is decoded or set
+            # until the screen is back, then it switches straight away
+            paused = monotonic()
+            while self.check_policy()['paused']:
+                if self.config.wait(CHECK_INTERVAL) and self.reload_config():
+                    return True
+            scheduler.delay(monotonic() - paused)
+    
+    def reload_config(self) -> bool:
+        """ Reload the config file if it changed. Returns True if the display
+        loop needs to restart, otherwise the changes are applied right away,
+        so the next image is pre-rendered with them while still waiting"""
+        if self.config.check_config_updated():
+            return True
+        if self.config.config_data['service'] != 'gsettings':
+            self.update_prerenderer()
+        return False
+    
+    def check_policy(self) -> dict:
+        """ Return the policy's state, see PowerPolicy.check. Hashing images
+        in the background is held back too when the system is busy or on
+        battery"""
+        state = self.policy.check(self.config.config_data)
+        self.config.index.hasher.set_paused(state['stretch'] > 1 or not state['prerender'])
+        return state
+    
+    def update_backend(self):
+        """ Make the desktop backend named in the config, unless the one
+        already made is it. Keeps the same connection across restarts"""
+        name = self.config.config_data['desktop_backend']
+        if self.backend is None or self.backend_name != name:
+            self.backend = create_backend(name, self.logger)
+            self.backend_name = name
         
     def use_gsettings(self):
         """ Use gsettings to display to one image"""
         print("In gsettings")
         
+        self.update_backend()
+        
+        # the first image is shown right away, after that each one is
+        # shown when the scheduler says
+        scheduler = Scheduler(self.config.config_data['monitor_timing'], self.logger)
+        due = []
         
         try:
+            # set gsettings mode once before displaying all images
+            self.backend.set_picture_options(self.config.config_data['gsettings_mode'])
+            
             while True:
-                # set gsettings mode once before displaying all images
-                os.system(f"gsettings set org.gnome.desktop.background picture-options {self.config.config_data['gsettings_mode']}")
-                shuffle(self.config.config_data['image_folders']['one_monitor'])
+                # carries on from the last run, without repeating an image
+                # until every one in its folder has been shown
+                f = self.selector.next_image(self.config.pool_folders['one_monitor'], self.config.config_data['folder_weights'])
+                self.selector.save()
                 
-                for f in self.config.config_data['image_folders']['one_monitor']:
-                    os.system(f"gsettings set org.gnome.desktop.background {self.config.config_data['gnome_color_theme']} file://{f}")
-                    sleep(self.config.config_data['switch_time'])
-                    
-                    # check if config file updated
-                    if self.config.check_config_updated():
-                        return # may not be using gsettings or invalid config
+                with timings.time("backend"):
+                    self.backend.set_picture_uri(self.config.config_data['gnome_color_theme'], f)
+                scheduler.advance(due, monotonic())
+                due = scheduler.next_monitors()
+                
+                # wait, checking if config file updated
+                if self.wait_for_switch(scheduler):
+                    return # may not be using gsettings or invalid config
+                
+                # pick up images added/removed, every image may be gone
+                self.config.apply_folder_changes()
+                if self.config.critical_error:
+                    return
                                                         
         except KeyboardInterrupt:
             self.logger.log("Keyboard interrupt detected, terminating program...")
             self.keyboard_interupt = True
             
            
-    def use_hydrapaper(self):
-        print("in hydrapaper")
+    def use_monitors(self):
+        """ Show a different image on each monitor, either with hydrapaper
+        or by spanning the joined image across all of them"""
+        print("in monitors")
+        
+        self.update_backend()
         
         try:
             
-            left_files = self.config.config_data['image_folders']['left_monitor']
-            right_files = self.config.config_data['image_folders']['right_monitor']
+            self.prerenderer.set_layout(self.config.config_data['monitor_layout'], self.config.config_data['fit_mode'])
+            self.update_prerenderer()
             
-            # use ints to index lists
-            left_index = 0
-            right_index = 0
+            # every monitor gets a first image
+            count = len(self.config.config_data['monitor_folders'])
+            upcoming = self.next_images([None] * count, range(count))
             
-            shuffle(left_files)
-            shuffle(right_files)
+            # the first images are shown right away, after that each
+            # monitor changes when the scheduler says. staggering is just
+            # each monitor having a different offset
+            scheduler = Scheduler(self.config.config_data['monitor_timing'], self.logger)
+            due = []
             
-            rights_turn = True  #flag for use when staggered, not used otherwise
+            # the images on screen, and joins that failed in a row
+            shown = None
+            failures = 0
 
             while True:
                 
-                # if index is too large, set to 0 and reshuffle
-                if left_index > len(left_files) - 1:
-                    left_index = 0
-                    shuffle(left_files)
-                if right_index > len(right_files) - 1:
-                    right_index = 0
-                    shuffle(right_files)
-                    
-                os.system(f"flatpak run org.gabmus.hydrapaper -c {left_files[left_index]} {right_files[right_index]}")
-                self.join_images([left_files[left_index], right_files[right_index]])
-                
-                if not self.config.config_data['hydrapaper_stagger']:
-                    left_index += 1
-                    right_index += 1
-                    
-                    sleep(self.config.config_data['switch_time'])
-                    
+                # the joined image has to be in place first, backends
+                # without hydrapaper span it across the screens
+                current = upcoming
+                if self.join_images(current):
+                    shown = current
+                    failures = 0
+                    with timings.time("backend"):
+                        if (self.config.config_data['service'] == 'hydrapaper'):
+                            self.backend.set_monitor_images(current, self.prerenderer.output_path)
+                        else:
+                            self.backend.set_spanned_image(self.prerenderer.output_path)
                 else:
-                    if rights_turn:
-                        right_index += 1
-                    else:
-                        left_index += 1
-                        
-                    sleep(self.config.config_data['switch_time'] / 2)
-                    rights_turn = not rights_turn
-                    
+                    # an image that can't be used, ie, over the decode limit.
+                    # what is on screen stays, and the monitors that were
+                    # changing get new images, tried straight away
+                    failures += 1
+                    changed = [monitor for monitor, path in enumerate(current) if shown is None or path != shown[monitor]]
+                    upcoming = self.next_images(current, changed)
+                    if failures < self.join_attempts:
+                        continue
+                    failures = 0
+                scheduler.advance(due, monotonic())
                 
-                # check if config file updated
-                if self.config.check_config_updated():
+                # pick images for the monitors that change next. done before
+                # sleeping so the next set is known and can be pre-rendered
+                due = scheduler.next_monitors()
+                upcoming = self.next_images(upcoming, due)
+                
+                # build the next joined image while waiting. when staggered
+                # only one monitor changes, and the others are reused. a busy
+                # system is left alone, and it is built when it is needed
+                if self.check_policy()['prerender']:
+                    self.prerenderer.submit(upcoming)
+                
+                # wait, checking if config file updated
+                if self.wait_for_switch(scheduler):
+                    # the queued set came from the old config
+                    self.prerenderer.cancel()
                     return # may not be using gsettings or invalid config
+                
+                # pick up images added/removed, every image may be gone
+                if self.config.apply_folder_changes():
+                    if self.config.critical_error:
+                        self.prerenderer.cancel()
+                        return
+                    
+                    # the queued set may include a deleted image
+                    gone = [monitor for monitor, path in enumerate(upcoming) if self.config.index.image_info(path) is None]
+                    if gone:
+                        upcoming = self.next_images(upcoming, gone)
+                        if self.check_policy()['prerender']:
+                            self.prerenderer.submit(upcoming)
                                                         
         except KeyboardInterrupt:
             self.logger.log("Keyboard interrupt detected, terminating program...")
             self.keyboard_interupt = True
     
     
-    def join_images(self, image_paths):
-        
-        # target size for each screen assume 1920x1080
-        target_width, target_height = 1920,1080
-        
-        # open and resize images
-        images = [Image.open(x).resize((target_width, target_height), Image.LANCZOS) for x in image_paths]
-        
-        # calculate dimensions for new image
-        total_width = target_width * len(images)
-        max_height = target_height
-
-        # create new image of combined width and height
-        new_im = Image.new('RGB', (total_width, max_height))
-
-        # 'paste' images onto larger image
-        x_offset = 0
-        for im in images:
-            new_im.paste(im, (x_offset,0))
-            x_offset += im.size[0]
-
-        # save in the current directory
-        new_im.save(self.directory + "/.joined_file.jpg")
+    def next_images(self, images : list[str], monitors) -> list[str]:
+        """ Return a copy of images, the image on each monitor, with a new
+        one picked for each of monitors. An image already on another
+        monitor isn't picked if there is any other choice"""
+        images = list(images)
+        for monitor in monitors:
+            others = {path for other, path in enumerate(images) if other != monitor}
+            images[monitor] = self.selector.next_image(self.config.config_data['monitor_folders'][monitor],
+                                                       self.config.config_data['folder_weights'], others)
+        self.selector.save()
+        return images
+    
+    
+    def update_prerenderer(self):
+        """ Apply the cache limits and output format from the config file,
+        none of which need the loop to restart"""
+        self.prerenderer.cache.max_bytes = self.config.config_data['resize_cache_mb'] * 1024 * 1024
+        self.prerenderer.cache.max_pixels = self.config.config_data['max_decode_megapixels'] * 1000000
+        self.prerenderer.set_output(self.config.config_data['output_format'], self.config.config_data['output_quality'])
+    
+    
+    def join_images(self, image_paths) -> bool:
+        """ Put the joined image for image_paths in place. Uses the
+        pre-rendered file if it was submitted ahead of time, otherwise
+        waits for it to be built. The time waited shows if pre-rendering
+        is keeping up. Returns False if it couldn't be built"""
+        with timings.time("join_wait"):
+            return self.prerenderer.swap_in(image_paths)
             
         
     
         
         
-if __name__ == "__main__":
-    switcher = WallPaperSwitcher()
-    
+def run(switcher : WallPaperSwitcher):
+    """ Run the display loops until interrupted"""
     while not switcher.keyboard_interupt:
         print("in main")
         if (not switcher.config.critical_error):
             if (switcher.config.config_data['service'] == 'gsettings'):
                 switcher.use_gsettings()
             else:
-                switcher.use_hydrapaper()
+                switcher.use_monitors()
         
         # check if updates. causes a second check if 
         # update caused it to leave one of the display loops, 
         # but allows program to keep running if config is messed up 
         # until it is fixed, without needing to find and run this script
         switcher.config.check_config_updated()
+        
+        # images added back to an emptied folder also fix the config
+        switcher.config.apply_folder_changes()
+        
+        # wait for the config to be fixed without spinning
+        if (switcher.config.critical_error):
+            switcher.config.wait(5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Switch the desktop wallpaper on an interval")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the timings of the running switcher and exit")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile the switcher with cProfile, saving the results to FILE on exit")
+    args = parser.parse_args()
+    
+    # the running switcher writes its timings next to the script
+    if (args.stats):
+        try:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".stats.json"), 'r') as f:
+                print(format_summary(json.load(f)))
+        except (OSError, ValueError):
+            print("No stats yet, they are written once the switcher has been running for a minute")
+        sys.exit(0)
+    
+    # being killed at logout still writes out the buffered log
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    switcher = WallPaperSwitcher()
+    atexit.register(timings.save, switcher.stats_path, True)
+    
+    if (args.profile):
+        import cProfile # only needed when profiling
+        # a profile only covers its own thread, so joining and hashing
+        # images are done on the main thread instead of in the background
+        switcher.prerenderer.inline = True
+        switcher.config.index.hasher.inline = True
+        profiler = cProfile.Profile()
+        atexit.register(profiler.dump_stats, args.profile)
+        profiler.runcall(run, switcher)
+    else:
+        run(switcher)
             
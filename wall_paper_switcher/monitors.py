@@ -0,0 +1,67 @@
+"""
+@brief - works out the monitor layout the spanned wallpaper is built for,
+         either from the config file or by asking xrandr, and where on the
+         joined image each monitor's wallpaper goes.
+
+         A monitor is a dict of x, y, width, height and scale. Position and
+         size are in layout pixels, and scale is how many device pixels
+         there are per layout pixel. xrandr already reports device pixels,
+         so detected monitors always have a scale of 1.
+"""
+
+
+import re  # to parse xrandr output
+import subprocess  # to run xrandr
+
+
+# ie, "HDMI-1 connected primary 1920x1080+1920+0 (normal left inverted ...) 527mm x 296mm"
+XRANDR_MONITOR = re.compile(r"^\S+ connected (?:primary )?(\d+)x(\d+)\+(\d+)\+(\d+)")
+
+
+def default_layout(count : int) -> list[dict]:
+    """ count 1920x1080 monitors side by side, the old assumed layout"""
+    return [{'x': 1920 * i, 'y': 0, 'width': 1920, 'height': 1080, 'scale': 1} for i in range(count)]
+
+
+def parse_xrandr(output : str) -> list[dict]:
+    """ Return the active monitors in xrandr --query output, ordered left
+    to right then top to bottom"""
+    monitors = []
+    for line in output.splitlines():
+        match = XRANDR_MONITOR.match(line)
+        if match:
+            width, height, x, y = (int(n) for n in match.groups())
+            monitors.append({'x': x, 'y': y, 'width': width, 'height': height, 'scale': 1})
+    return sorted(monitors, key=lambda m: (m['x'], m['y']))
+
+
+def detect_layout(logger) -> list[dict]:
+    """ Ask xrandr for the monitor layout, returns an empty list if it
+    could not be found"""
+    try:
+        result = subprocess.run(["xrandr", "--query"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.log(f"ERROR: could not run xrandr: {e}")
+        return []
+    if result.returncode != 0:
+        logger.log(f"ERROR: xrandr failed: {result.stderr.strip()}")
+        return []
+    return parse_xrandr(result.stdout)
+
+
+def canvas_regions(layout : list[dict]) -> tuple:
+    """ Return the size of the joined image for layout, and the box
+    (x, y, width, height) on it for each monitor. The image is made at
+    the highest monitor scale, so HiDPI monitors get full detail"""
+    scale = max(m['scale'] for m in layout)
+    left = min(m['x'] for m in layout)
+    top = min(m['y'] for m in layout)
+
+    regions = []
+    for m in layout:
+        regions.append((round((m['x'] - left) * scale), round((m['y'] - top) * scale),
+                        round(m['width'] * scale), round(m['height'] * scale)))
+
+    width = max(x + w for x, _, w, _ in regions)
+    height = max(y + h for _, y, _, h in regions)
+    return (width, height), regions
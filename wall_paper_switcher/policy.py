@@ -0,0 +1,198 @@
+"""
+@brief - decides when switching wallpapers isn't worth the CPU and disk it
+         costs, so the switcher steps aside for whatever else is running.
+
+         While the screen is locked or blanked nobody can see the wallpaper,
+         so switching pauses. On battery the schedule is stretched out, and
+         when the system is busy the next image isn't rendered ahead of time.
+
+         The state of the machine comes from a source. DesktopSource asks
+         the GNOME screensaver over D-Bus, and reads the battery from sysfs
+         and the load average from the kernel. StubSource reads the same
+         state from a JSON file instead, for running without a desktop.
+"""
+
+
+import os  # for the load average and sysfs
+import json  # to read the stub file
+from time import monotonic  # to only check every so often
+
+# PyGObject is optional, the screen is assumed to be on without it
+try:
+    from gi.repository import Gio
+except ImportError:
+    Gio = None
+
+
+# how long a check of the machine's state is reused, in seconds
+CHECK_INTERVAL = 5
+
+POWER_SUPPLIES = "/sys/class/power_supply/"
+
+
+class DesktopSource():
+    """
+            The real state of the machine. Anything that can't be read is
+            taken as the screen being on, on mains power, and idle.
+
+            Class Members:
+                screensaver : Gio.DBusProxy - org.gnome.ScreenSaver, or None if it isn't available
+    """
+
+    name = "auto"
+
+    def __init__(self):
+
+        self.screensaver = None
+        if Gio is not None:
+            try:
+                self.screensaver = Gio.DBusProxy.new_for_bus_sync(
+                    Gio.BusType.SESSION, Gio.DBusProxyFlags.NONE, None,
+                    "org.gnome.ScreenSaver", "/org/gnome/ScreenSaver", "org.gnome.ScreenSaver", None)
+            except Exception:
+                # GLib.Error, ie, no session bus
+                self.screensaver = None
+
+    def screen_off(self) -> bool:
+        """ If the screen is locked or blanked"""
+        if self.screensaver is None:
+            return False
+        try:
+            return bool(self.screensaver.call_sync("GetActive", None, Gio.DBusCallFlags.NONE, 1000, None).unpack()[0])
+        except Exception:
+            return False
+
+    def on_battery(self) -> bool:
+        """ If there is a battery and no mains power is connected"""
+        try:
+            supplies = os.listdir(POWER_SUPPLIES)
+        except OSError:
+            return False
+
+        battery = False
+        for supply in supplies:
+            try:
+                with open(os.path.join(POWER_SUPPLIES, supply, "type")) as f:
+                    kind = f.read().strip()
+                if kind == "Mains":
+                    with open(os.path.join(POWER_SUPPLIES, supply, "online")) as f:
+                        if f.read().strip() == "1":
+                            return False
+                elif kind == "Battery":
+                    battery = True
+            except OSError:
+                continue
+        return battery
+
+    def load(self) -> float:
+        """ The 1 minute load average per CPU, 1.0 is every CPU busy"""
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0.0
+
+
+class StubSource():
+    """
+            Machine state read from a JSON file, ie,
+            {"screen_off": false, "on_battery": true, "load": 0.5}
+            Missing keys, or a missing file, are the screen on, on mains
+            power, and idle.
+
+            Class Members:
+                path : str - the full path to the stub file
+    """
+
+    name = "stub"
+
+    def __init__(self, path : str):
+        self.path = path
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def screen_off(self) -> bool:
+        return bool(self.read().get('screen_off', False))
+
+    def on_battery(self) -> bool:
+        return bool(self.read().get('on_battery', False))
+
+    def load(self) -> float:
+        try:
+            return float(self.read().get('load', 0.0))
+        except (TypeError, ValueError):
+            return 0.0
+
+
+class PowerPolicy():
+    """
+            Turns the machine's state into what the display loops should do.
+            A check is reused for CHECK_INTERVAL seconds, and changes are
+            logged as they happen.
+
+            Class Members:
+                logger : ErrorLogger - where changes are logged
+                stub_path : str - the file StubSource reads
+                source : DesktopSource or StubSource - made for the 'policy_source' config field
+                state : dict - the last check, see check
+                checked : float - monotonic time of the last check
+    """
+
+    # what the loops do when nothing is holding them back
+    normal = {'paused': False, 'stretch': 1, 'prerender': True}
+
+    def __init__(self, logger, directory : str):
+
+        self.logger = logger
+        self.stub_path = directory + ".policy_stub.json"
+        self.source = None
+        self.state = dict(self.normal)
+        self.checked = None
+
+    def check(self, config_data : dict) -> dict:
+        """ Return whether switching is 'paused', what to multiply each
+        interval by as 'stretch', and whether to 'prerender' the next image"""
+        name = config_data.get('policy_source', 'off')
+        if name == 'off':
+            self.update(dict(self.normal), [])
+            return self.state
+
+        now = monotonic()
+        if self.source is not None and self.source.name == name and self.checked is not None and now - self.checked < CHECK_INTERVAL:
+            return self.state
+        self.checked = now
+
+        if self.source is None or self.source.name != name:
+            self.source = StubSource(self.stub_path) if name == 'stub' else DesktopSource()
+
+        state = dict(self.normal)
+        reasons = []
+        if config_data.get('pause_when_locked', True) and self.source.screen_off():
+            state['paused'] = True
+            reasons.append("the screen is locked or blank")
+        if config_data.get('battery_stretch', 1) > 1 and self.source.on_battery():
+            state['stretch'] = config_data['battery_stretch']
+            reasons.append(f"on battery, switching {state['stretch']}x less often")
+        load = self.source.load()
+        max_load = config_data.get('max_load_percent', 0) / 100
+        if max_load > 0 and load > max_load:
+            state['prerender'] = False
+            reasons.append(f"load is {load:.0%} per CPU, not rendering ahead")
+
+        self.update(state, reasons)
+        return self.state
+
+    def update(self, state : dict, reasons : list[str]):
+        """ Keep state, logging it if it changed"""
+        if state == self.state:
+            return
+        self.state = state
+        if reasons:
+            self.logger.log(f"Holding back: {', '.join(reasons)}")
+        else:
+            self.logger.log("Switching normally again")
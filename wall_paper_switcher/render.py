@@ -0,0 +1,496 @@
+"""
+@brief - builds the joined wallpaper image on a worker thread, so the
+         expensive decode/resize/encode happens while the switcher is
+         sleeping instead of at the moment the wallpaper changes.
+
+         The switch loop submits the pair it is going to show next, and on
+         the following tick swaps the finished file into place.
+
+         Resized copies of each source are kept in an on-disk cache, so the
+         second time an image comes up in the shuffle it only needs a small
+         decode instead of a full resolution decode and resize.
+
+         Sources much larger than the screen are shrunk while decoding
+         where the format allows it (JPEG), and otherwise reduced by an
+         integer factor before the final resize. A JPEG's peak memory
+         follows the output size, other formats hold one decoded source,
+         and are only converted to RGB once they are resized.
+
+         Each monitor has a fit mode, for images that aren't the same shape
+         as the monitor. The part of the source that is used is worked out
+         from its size up front, so only that part is resampled.
+"""
+
+
+import os  # to move the finished image into place
+import threading  # to render in the background
+import hashlib  # to name cached images
+from PIL import Image  # used to join pictures together manually
+from time import perf_counter  # to time cache hits
+from monitors import canvas_regions, default_layout  # where each monitor's image goes
+from stats import timings  # how long each stage takes
+from image_index import JPEG_FORMATS  # formats that can be decoded at a reduced size
+
+
+# resize does a cheap integer reduce first when the source is at least
+# this many times larger than the target, before the LANCZOS pass
+REDUCING_GAP = 2.0
+
+# modes that are resized as they are and converted to RGB after. anything
+# else is converted first, palette, 1 bit and cmyk can't be resized, and
+# images with alpha are resized through a premultiplied full size copy
+RESIZE_MODES = {"RGB", "L"}
+
+# 'output_format' -> (Pillow format, file extension) of the joined image.
+# bmp is uncompressed, so it costs the most disk but the least CPU
+OUTPUT_FORMATS = {'jpeg': ("JPEG", ".jpg"), 'png': ("PNG", ".png"), 'bmp': ("BMP", ".bmp")}
+
+# how an image is fit to a monitor that isn't the same shape
+#   zoom - scaled to cover the monitor, the edges that don't fit are cropped
+#   fit - scaled to fit inside the monitor, with black bars on the sides
+#   center - not scaled, centered and cropped if larger than the monitor
+#   stretch - scaled to exactly the monitor size, ignoring the shape
+FIT_MODES = ['zoom', 'fit', 'center', 'stretch']
+
+
+def fit_boxes(source_size : tuple, size : tuple, fit : str) -> tuple:
+    """ For fitting an image of source_size into size, return the box
+    (left, top, right, bottom) of the source that is used, the size that
+    box is resized to, and the offset it is pasted at"""
+    source_width, source_height = source_size
+    width, height = size
+
+    if fit == 'stretch':
+        return (0, 0, source_width, source_height), size, (0, 0)
+
+    if fit == 'zoom':
+        scale = max(width / source_width, height / source_height)
+        crop_width, crop_height = width / scale, height / scale
+        left, top = (source_width - crop_width) / 2, (source_height - crop_height) / 2
+        return (left, top, left + crop_width, top + crop_height), size, (0, 0)
+
+    if fit == 'fit':
+        scale = min(width / source_width, height / source_height)
+        resized = (max(1, round(source_width * scale)), max(1, round(source_height * scale)))
+        return (0, 0, source_width, source_height), resized, ((width - resized[0]) // 2, (height - resized[1]) // 2)
+
+    # center
+    crop_width, crop_height = min(source_width, width), min(source_height, height)
+    left, top = (source_width - crop_width) // 2, (source_height - crop_height) // 2
+    return (left, top, left + crop_width, top + crop_height), (crop_width, crop_height), ((width - crop_width) // 2, (height - crop_height) // 2)
+
+
+def load_resized(source : str, size : tuple, fit : str, max_pixels : int, logger, source_size : tuple = None) -> Image.Image:
+    """ Open source and fit it to size, decoding at reduced resolution
+    when possible. source_size is the size already known from the image
+    index, if any. Raises ValueError if the image would still decode to
+    more than max_pixels, rather than allocating it"""
+    im = Image.open(source)
+    original = im.size
+
+    # the index may be out of date if the file was just replaced
+    if source_size is None or tuple(source_size) != original:
+        source_size = original
+    box, resized, offset = fit_boxes(source_size, size, fit)
+
+    # jpeg can decode straight to 1/2, 1/4 or 1/8 scale. draft picks the
+    # smallest of those where the box still covers its resized size.
+    # other formats have no shrink-on-load, and decode at full size
+    if im.format in JPEG_FORMATS:
+        scale_x = resized[0] / (box[2] - box[0])
+        scale_y = resized[1] / (box[3] - box[1])
+        im.draft('RGB', (-(-original[0] * scale_x // 1), -(-original[1] * scale_y // 1)))
+    decoded = im.size
+
+    if decoded[0] * decoded[1] > max_pixels:
+        raise ValueError(f"{decoded[0]}x{decoded[1]} is over the decode limit of {max_pixels // 1000000} megapixels")
+
+    # the box is in source pixels, move it onto the drafted image
+    ratio_x, ratio_y = decoded[0] / original[0], decoded[1] / original[1]
+    box = (box[0] * ratio_x, box[1] * ratio_y, box[2] * ratio_x, box[3] * ratio_y)
+
+    # the integer reduce inside resize kicks in at the same ratio it uses
+    reduced = min((box[2] - box[0]) / resized[0], (box[3] - box[1]) / resized[1]) // REDUCING_GAP > 1
+
+    if decoded != original or reduced:
+        stages = [f"{original[0]}x{original[1]}"]
+        if decoded != original:
+            stages.append(f"draft {decoded[0]}x{decoded[1]}")
+        if reduced:
+            stages.append("reduce")
+        stages.append(f"{resized[0]}x{resized[1]}")
+        logger.log(f"Downsampled in stages '{source}': {' -> '.join(stages)}", 'debug')
+
+    # converting makes a full size copy, so it is done on the resized
+    # image where possible, keeping memory to one decoded source
+    with timings.time("decode"):
+        im.load()
+        if im.mode not in RESIZE_MODES:
+            im = im.convert('RGB')
+    with timings.time("resize"):
+        im = im.resize(resized, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+
+    # fit and center can leave bars around the image
+    if resized != tuple(size) or offset != (0, 0):
+        framed = Image.new('RGB', size)
+        framed.paste(im, offset)
+        im = framed
+    return im
+
+
+def remove_file(path : str):
+    """ Delete path if it exists"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ResizeCache():
+    """
+            Directory of source images already resized to a monitor's size.
+            Entries are keyed by source path, mtime, file size, target size
+            and fit mode, so editing or replacing a source never returns a
+            stale copy.
+            
+            The cached file's mtime doubles as its last-used time, and the
+            least recently used entries are deleted once the directory grows
+            past the byte budget.
+
+            Class Members:
+                logger : ErrorLogger - where staged downsampling is noted
+                path : str - the cache directory
+                max_bytes : int - byte budget, 0 disables the cache
+                max_pixels : int - largest decode allowed for a source
+                lossless : bool - if copies are kept as png rather than jpeg, for lossless joined images
+                total_bytes : int - current size of all cached files
+    """
+    def __init__(self, logger, directory : str, max_bytes : int, max_pixels : int):
+
+        self.logger = logger
+        self.path = directory + ".resize_cache/"
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.lossless = False
+        os.makedirs(self.path, exist_ok=True)
+
+        # count what is already on disk from previous runs
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.path))
+
+    def key_path(self, source : str, size : tuple, fit : str) -> str:
+        """ Return the path the resized copy of source would be cached at"""
+        stat = os.stat(source)
+        key = f"{os.path.abspath(source)}|{stat.st_mtime_ns}|{stat.st_size}|{size[0]}x{size[1]}|{fit}"
+        return self.path + hashlib.sha1(key.encode()).hexdigest() + (".png" if self.lossless else ".jpg")
+
+    def load(self, source : str, size : tuple, fit : str, source_size : tuple = None) -> Image.Image:
+        """ Return source fit to size, from the cache if possible.
+        Resized images that were not cached are added to it"""
+        if self.max_bytes <= 0:
+            return load_resized(source, size, fit, self.max_pixels, self.logger, source_size)
+
+        cached = self.key_path(source, size, fit)
+        start = perf_counter()
+        try:
+            im = Image.open(cached)
+            im.load()
+            # mark as recently used for eviction
+            os.utime(cached)
+            timings.record("cache_read", perf_counter() - start)
+            return im
+        except (OSError, ValueError):
+            pass
+
+        im = load_resized(source, size, fit, self.max_pixels, self.logger, source_size)
+        with timings.time("cache_write"):
+            self.store(cached, im)
+        return im
+
+    def store(self, cached : str, im : Image.Image):
+        """ Write im to the cache, then evict down to the byte budget"""
+        # write to a temp file first so a crash never leaves half an image
+        temp = cached + ".tmp"
+        # png is saved with light compression, it is read back far more
+        # often than written, and a smaller file barely decodes faster
+        if cached.endswith(".png"):
+            im.save(temp, format="PNG", compress_level=1)
+        else:
+            im.save(temp, format="JPEG", quality=95)
+        os.replace(temp, cached)
+        self.total_bytes += os.path.getsize(cached)
+        self.evict()
+
+    def evict(self):
+        """ Delete least recently used entries until under max_bytes"""
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        entries = sorted(os.scandir(self.path), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+
+class PreRenderer():
+    """
+            Render the joined image for the upcoming set of wallpapers on a
+            background thread. Only one render runs at a time, and submitting
+            a new set replaces any set still waiting to be rendered.
+            
+            The joined image covers the whole monitor layout, with one
+            wallpaper resized into each monitor's region of it.
+
+            Finished images alternate between two buffer files, so the file
+            the desktop is showing is never written to, and the desktop is
+            always given a new path it has to reload.
+
+            Class Members:
+                logger : ErrorLogger - where render errors are written
+                directory : str - where the joined files are kept
+                output_format : str - key of OUTPUT_FORMATS the joined file is saved as
+                output_quality : int - jpeg quality, or png compression level
+                buffer : int - which buffer file, 0 or 1, the desktop is showing
+                output_path : str - the joined file the desktop is showing
+                staging_path : str - where the next joined file is built
+                cache : ResizeCache - resized copies of source images
+                image_info : function - path -> image index entry, for source sizes
+                inline : bool - if sets are rendered by swap_in on the calling thread instead, ie, when profiling
+                condition : threading.Condition - guards all state below
+                canvas_size : tuple - size of the joined image, (width, height)
+                regions : list - (x, y, width, height) on the joined image for each monitor
+                fits : list - fit mode for each monitor
+                generation : int - bumped on every submit/cancel, so stale renders are dropped
+                job : tuple - paths waiting for the worker, or None
+                pending : tuple - paths currently being rendered, or None
+                ready : tuple - paths whose joined image is finished in staging_path
+                failed : tuple - paths whose render raised an error
+                resized : dict - (path, size, fit) -> resized image from the last render
+                canvas : Image - the joined image, reused while the layout stays the same
+    """
+    def __init__(self, logger, directory : str, cache : ResizeCache, image_info):
+
+        self.logger = logger
+        self.directory = directory
+        self.output_format = 'jpeg'
+        self.output_quality = 95
+        self.buffer = 0
+        self.output_path = directory + ".joined_file.0.jpg"
+        self.staging_path = directory + ".joined_file.next.jpg"
+        self.cache = cache
+        self.image_info = image_info
+        self.inline = False
+
+        self.condition = threading.Condition()
+        self.canvas_size, self.regions = canvas_regions(default_layout(2))
+        self.fits = ['zoom', 'zoom']
+        self.canvas = None
+        self.generation = 0
+        self.job = None
+        self.pending = None
+        self.ready = None
+        self.failed = None
+
+        # with stagger only one side changes per tick, so keep the resized
+        # images from the last render around and reuse the unchanged side
+        self.resized = {}
+
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def submit(self, image_paths):
+        """ Queue the joined image for image_paths to be built in the
+        background. Does nothing if it is already queued, running or done,
+        or if it failed, as it would only fail again. Inline renders wait
+        for swap_in"""
+        if self.inline:
+            return
+        paths = tuple(image_paths)
+        with self.condition:
+            if paths in (self.job, self.pending, self.ready, self.failed):
+                return
+            self.generation += 1
+            self.job = paths
+            self.ready = None
+            self.failed = None
+            self.condition.notify_all()
+
+    def set_layout(self, layout : list[dict], fits : list[str]):
+        """ Change the monitor layout and fit modes joined images are built
+        for. Drops anything rendered for the old layout"""
+        canvas_size, regions = canvas_regions(layout)
+        with self.condition:
+            if (canvas_size, regions, fits) == (self.canvas_size, self.regions, self.fits):
+                return
+            self.canvas_size = canvas_size
+            self.regions = regions
+            self.fits = list(fits)
+        self.cancel()
+
+    def set_output(self, output_format : str, quality : int):
+        """ Change the format and quality joined images are saved with.
+        The upcoming set is rendered again with them, and files saved in
+        other formats are deleted, apart from the one on screen, which goes
+        once it is replaced. Resized copies are cached losslessly too
+        unless the joined image is a jpeg"""
+        self.cache.lossless = output_format != 'jpeg'
+        with self.condition:
+            if (output_format, quality) == (self.output_format, self.output_quality):
+                return
+            self.output_format = output_format
+            self.output_quality = quality
+            self.staging_path = self.directory + ".joined_file.next" + OUTPUT_FORMATS[output_format][1]
+            upcoming = self.job or self.pending or self.ready
+        self.cancel()
+        if upcoming is not None:
+            self.submit(upcoming)
+
+        for _, extension in OUTPUT_FORMATS.values():
+            if extension == OUTPUT_FORMATS[output_format][1]:
+                continue
+            for name in ("0", "1", "next"):
+                path = f"{self.directory}.joined_file.{name}{extension}"
+                if path != self.output_path:
+                    remove_file(path)
+
+    def cancel(self):
+        """ Drop any queued or in-progress render, ie, when the config file
+        changed and the upcoming images are no longer valid"""
+        with self.condition:
+            self.generation += 1
+            self.job = None
+            self.ready = None
+            self.failed = None
+            self.condition.notify_all()
+
+    def swap_in(self, image_paths) -> bool:
+        """ Move the finished joined image for image_paths into place. If it
+        was never submitted, or is still rendering, waits for it to finish.
+        Returns False if the render failed"""
+        paths = tuple(image_paths)
+        if self.inline:
+            with self.condition:
+                job = self._take(paths) if paths not in (self.ready, self.failed) else None
+            if job is not None:
+                self._run(paths, job)
+        else:
+            self.submit(paths)
+
+        with self.condition:
+            while self.ready != paths and self.failed != paths:
+                # a different submit or a cancel replaced this set
+                if paths not in (self.job, self.pending):
+                    return False
+                self.condition.wait()
+
+            if self.failed == paths:
+                return False
+
+            # the other buffer is not on screen, so it is safe to replace
+            self.buffer = 1 - self.buffer
+            output_path = f"{self.directory}.joined_file.{self.buffer}{OUTPUT_FORMATS[self.output_format][1]}"
+            os.replace(self.staging_path, output_path)
+            previous = self.output_path
+            self.output_path = output_path
+            self.ready = None
+
+        # the format changed since the last one was shown
+        if os.path.splitext(previous)[1] != os.path.splitext(output_path)[1]:
+            remove_file(previous)
+        return True
+
+    def _work(self):
+        """ Worker thread, renders whatever the latest job is"""
+        while True:
+            with self.condition:
+                while self.job is None:
+                    self.condition.wait()
+                paths = self.job
+                self.job = None
+                job = self._take(paths)
+            self._run(paths, job)
+
+    def _take(self, paths : tuple) -> tuple:
+        """ Mark paths as being rendered, and return the settings to render
+        it with, (generation, canvas size, regions, fits, output). Called
+        with the condition held"""
+        self.pending = paths
+        return (self.generation, self.canvas_size, self.regions, self.fits,
+                (self.staging_path, self.output_format, self.output_quality))
+
+    def _run(self, paths : tuple, job : tuple):
+        """ Render paths with the settings from _take, and publish the result"""
+        generation = job[0]
+        try:
+            with timings.time("render"):
+                finished = self._render(paths, *job)
+            error = None
+        except Exception as e:
+            finished = False
+            error = e
+
+        with self.condition:
+            self.pending = None
+            # only publish the result if nothing was submitted meanwhile
+            if generation == self.generation:
+                if finished:
+                    self.ready = paths
+                elif error is not None:
+                    self.failed = paths
+                    self.logger.log(f"ERROR: could not join images {list(paths)}: {error}")
+            elif finished and job[4][0] != self.staging_path:
+                # saved in a format that was changed part way through
+                remove_file(job[4][0])
+            self.condition.notify_all()
+
+    def _render(self, image_paths, generation : int, canvas_size : tuple, regions : list, fits : list, output : tuple) -> bool:
+        """ Join the images, image i going in regions[i] using fits[i], and
+        save it as output, (path, format, quality). Returns False without
+        writing anything if the render went stale part way through"""
+
+        # open and resize images, reusing any monitor that did not change
+        images = []
+        for path, (_, _, width, height), fit in zip(image_paths, regions, fits):
+            if generation != self.generation:
+                return False
+            key = (path, (width, height), fit)
+            if key not in self.resized:
+                info = self.image_info(path)
+                source_size = (info['width'], info['height']) if info and 'width' in info else None
+                self.resized[key] = self.cache.load(path, (width, height), fit, source_size)
+            images.append(self.resized[key])
+
+        # forget images that are no longer on screen
+        self.resized = {key: self.resized[key] for key in self.resized if key[0] in image_paths}
+
+        # the canvas is only made again when the layout changes, monitors
+        # cover the same region every time so it is just pasted over
+        if self.canvas is None or self.canvas.info.get('regions') != regions:
+            self.canvas = Image.new('RGB', canvas_size)
+            self.canvas.info['regions'] = regions
+
+        # 'paste' images onto larger image
+        with timings.time("paste"):
+            for im, (x, y, _, _) in zip(images, regions):
+                self.canvas.paste(im, (x, y))
+
+        if generation != self.generation:
+            return False
+
+        path, output_format, quality = output
+        if output_format == 'jpeg':
+            options = {'quality': quality}
+        elif output_format == 'png':
+            options = {'compress_level': quality}
+        else:
+            options = {}
+        with timings.time("encode"):
+            self.canvas.save(path, format=OUTPUT_FORMATS[output_format][0], **options)
+        return True
@@ -0,0 +1,94 @@
+"""
+@brief - decides when each monitor's wallpaper changes. Deadlines are kept
+         on time.monotonic() and each one is moved on from when it was due,
+         not from when the switch finished, so time spent decoding and
+         setting the wallpaper never builds up as drift.
+
+         Each monitor has its own interval and offset. Staggered monitors
+         are just the same interval with different offsets.
+
+         The schedule can be stretched, ie, on battery, and pushed back
+         while switching is paused, without counting as late.
+"""
+
+
+from time import monotonic  # deadlines are unaffected by clock changes
+
+
+# how late a switch can be before it is logged, in seconds
+LATE_TOLERANCE = 0.5
+
+
+def stagger_timing(count : int, interval : float, stagger : bool) -> list[tuple]:
+    """ Return (interval, offset) for count monitors that all change every
+    interval seconds. If stagger, the changes are spread out evenly, the
+    last monitor changing first, then the first, second, and so on"""
+    if not stagger or count < 2:
+        return [(interval, interval)] * count
+
+    step = interval / count
+    timing = [(interval, (monitor + 2) * step) for monitor in range(count)]
+    timing[-1] = (interval, step)
+    return timing
+
+
+class Scheduler():
+    """
+            Fixed cadence of change events for each monitor.
+
+            Class Members:
+                logger : ErrorLogger - where late switches are logged
+                intervals : list - seconds between changes, per monitor
+                stretch : float - every interval is multiplied by this
+                deadlines : list - monotonic time of the next change, per monitor
+                late_ticks : int - count of switches that were late
+                skipped_ticks : int - count of switches missed entirely, ie, after suspend
+    """
+    def __init__(self, timing : list[tuple], logger, start : float = None):
+
+        self.logger = logger
+        if start is None:
+            start = monotonic()
+
+        self.intervals = [interval for interval, _ in timing]
+        self.stretch = 1
+        self.deadlines = [start + offset for _, offset in timing]
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+
+    def next_deadline(self) -> float:
+        """ Monotonic time of the next change on any monitor"""
+        return min(self.deadlines)
+
+    def next_monitors(self) -> list[int]:
+        """ The monitors that change at the next deadline"""
+        deadline = self.next_deadline()
+        return [monitor for monitor, due in enumerate(self.deadlines) if due - deadline < 0.001]
+
+    def advance(self, monitors : list[int], finished : float):
+        """ Mark monitors as changed, with the change on screen at the
+        monotonic time finished. Logs if that was late, and moves each
+        deadline on by its interval, skipping any that were missed"""
+        for monitor in monitors:
+            deadline = self.deadlines[monitor]
+            interval = self.intervals[monitor] * self.stretch
+
+            late = finished - deadline
+            if late > LATE_TOLERANCE:
+                self.late_ticks += 1
+                self.logger.log(f"Late switch on monitor {monitor + 1}: {late:.2f}s behind schedule")
+
+            deadline += interval
+            skipped = 0
+            while deadline <= finished:
+                deadline += interval
+                skipped += 1
+            if skipped:
+                self.skipped_ticks += skipped
+                self.logger.log(f"Skipped {skipped} switch(es) on monitor {monitor + 1} to get back on schedule")
+
+            self.deadlines[monitor] = deadline
+
+    def delay(self, seconds : float):
+        """ Push every deadline back by seconds, ie, after a pause"""
+        self.deadlines = [deadline + seconds for deadline in self.deadlines]
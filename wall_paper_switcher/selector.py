@@ -0,0 +1,225 @@
+"""
+@brief - picks the next wallpaper without repeats, and remembers where it
+         got to between runs.
+
+         Each folder is gone through in a shuffled order, and every image
+         in it is shown once before any is shown again. The order is never
+         stored as a list. Position i of the order is worked out from a
+         seed with a small Feistel network, so only the seed and how far
+         through the folder it got are kept, however many images it has.
+
+         Which folder the next image comes from is picked at random,
+         weighted by the number of images in it times its weight from the
+         config file, so with no weights every image is as likely as any
+         other, like one big shuffled list.
+
+         Near-duplicates, ie, the same picture saved at two sizes, are found
+         from the perceptual hashes in the image index, and only the largest
+         copy is ever picked.
+"""
+
+
+import os  # to build image paths
+import json  # to read/write the state file
+import random  # to pick folders and new seeds
+
+
+# bump when the layout of the state file changes, older state is dropped
+STATE_VERSION = 1
+
+# number of Feistel rounds, enough to make the order look random
+ROUNDS = 4
+
+MASK64 = (1 << 64) - 1
+
+# hashes this many bits apart or fewer are treated as the same picture
+DUPLICATE_DISTANCE = 4
+
+# the 64 bit hash is split into DUPLICATE_DISTANCE + 1 bands. two hashes
+# that close differ in at most DUPLICATE_DISTANCE bands, so they are equal
+# in at least one, and only images sharing a band are ever compared
+BAND_SHIFTS = [0, 13, 26, 39, 52]
+BAND_MASK = (1 << 13) - 1
+
+
+def _mix(value : int) -> int:
+    """ splitmix64 finaliser, scrambles the bits of a 64 bit value"""
+    value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    value = (value ^ (value >> 27)) * 0x94d049bb133111eb & MASK64
+    return value ^ (value >> 31)
+
+
+def permute(index : int, size : int, seed : int) -> int:
+    """ Return where index goes in a shuffled order of size items. The
+    same seed always gives the same order, and every index in range(size)
+    maps to a different position"""
+    # a Feistel network shuffles numbers of an even number of bits. numbers
+    # past the end are put through again until they land inside it, which
+    # takes under 4 tries on average as the range is at most 4x size
+    bits = max(2, (size - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+
+    while True:
+        left, right = index >> half, index & mask
+        for round_number in range(ROUNDS):
+            left, right = right, left ^ (_mix(seed ^ (round_number << 56) ^ right) & mask)
+        index = (left << half) | right
+        if index < size:
+            return index
+
+
+class ImageSelector():
+    """
+            Picks images from folders in the image index, persisting a
+            cursor into each folder's shuffled order.
+
+            Class Members:
+                logger : ErrorLogger - where state file errors are logged
+                path : str - the full path to the state file
+                index : ImageIndex - the folder contents images are picked from
+                folders : dict - folder -> {"seed": int, "cursor": int}
+                names : dict - folder -> (what it was built from, sorted image names), rebuilt when a folder or the decode limit changes
+                duplicates : dict - folder list -> (what it was built from, folder -> names to skip)
+                dirty : bool - if folders changed since the last save
+    """
+
+    def __init__(self, logger, directory : str, index):
+
+        self.logger = logger
+        self.path = directory + ".shuffle_state.json"
+        self.index = index
+        self.names = {}
+        self.duplicates = {}
+        self.dirty = False
+
+        # missing or old state just means every folder starts a new order
+        self.folders = {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                self.folders = data['folders']
+        except (OSError, ValueError, AttributeError, KeyError):
+            pass
+
+    def folder_names(self, folder : str) -> list[str]:
+        """ Return the usable image names in folder, sorted so position i
+        means the same image from run to run. Images too large to decode
+        are left out, and logged"""
+        entry = self.index.folders.get(folder)
+        if entry is None:
+            return []
+
+        key = (entry['mtime'], len(entry['files']), self.index.max_pixels)
+        cached = self.names.get(folder)
+        if cached is None or cached[0] != key:
+            names = sorted(name for name, info in entry['files'].items() if self.index.usable(info))
+            too_large = sum('error' not in info for info in entry['files'].values()) - len(names)
+            if too_large:
+                self.logger.log(f"ERROR: skipping {too_large} image(s) over the decode limit in '{folder}'")
+            cached = (key, names)
+            self.names[folder] = cached
+        return cached[1]
+
+    def skipped(self, folders : list[str]) -> dict:
+        """ Return folder -> names in it to skip, because a larger copy of
+        the same picture is in one of folders. Only worked out again when
+        the folders, their contents or the hashes change"""
+        names = {folder: self.folder_names(folder) for folder in folders}
+        key = (self.index.hash_version, tuple(self.names.get(folder, (None,))[0] for folder in names))
+        previous_key, previous = self.duplicates.get(tuple(folders), (None, {}))
+        if previous_key == key:
+            return previous
+
+        images = []
+        for folder in names:
+            files = self.index.folders[folder]['files'] if names[folder] else {}
+            for name in names[folder]:
+                info = files[name]
+                if info.get('dhash') is not None:
+                    images.append((info['width'] * info['height'], folder, name, info['dhash']))
+
+        # largest first, so the copy of each picture that is kept is the best one
+        images.sort(key=lambda image: image[0], reverse=True)
+
+        skip = {folder: set() for folder in names}
+        kept = []
+        bands = {}
+        for _, folder, name, value in images:
+            keys = [(band, (value >> shift) & BAND_MASK) for band, shift in enumerate(BAND_SHIFTS)]
+            similar = {other for band_key in keys for other in bands.get(band_key, ())}
+            if any(bin(value ^ kept[other]).count('1') <= DUPLICATE_DISTANCE for other in similar):
+                skip[folder].add(name)
+                continue
+
+            for band_key in keys:
+                bands.setdefault(band_key, []).append(len(kept))
+            kept.append(value)
+
+        count = sum(len(names) for names in skip.values())
+        if count != sum(len(names) for names in previous.values()):
+            self.logger.log(f"Skipping {count} near-duplicate image(s) in {list(names)}")
+        self.duplicates[tuple(folders)] = (key, skip)
+        return skip
+
+    def next_in_folder(self, folder : str, skip : set) -> str:
+        """ Return the next image of folder's shuffled order that isn't in
+        skip, starting a new order once every image has been shown"""
+        names = self.folder_names(folder)
+        state = self.folders.get(folder)
+
+        # a folder that is all duplicates still gives back an image
+        for _ in range(len(names)):
+            # images added or removed part way through change the order, so
+            # the rest of it may repeat or miss a few images until it starts over
+            if state is None or state['cursor'] >= len(names):
+                state = {'seed': random.getrandbits(64), 'cursor': 0}
+                self.folders[folder] = state
+
+            name = names[permute(state['cursor'], len(names), state['seed'])]
+            state['cursor'] += 1
+            if name not in skip:
+                break
+
+        self.dirty = True
+        return os.path.join(folder, name)
+
+    def next_image(self, folders : list[str], weights : dict, avoid : set = frozenset()) -> str:
+        """ Return the next image from one of folders, picked by weight,
+        skipping anything in avoid, ie, images on other monitors, unless
+        there is nothing else. Returns None if the folders are empty"""
+        skip = self.skipped(folders)
+        sizes = [(len(self.folder_names(folder)) - len(skip[folder])) * weights.get(folder, 1) for folder in folders]
+        if not any(sizes):
+            # every folder with images has a weight of 0, so ignore them
+            sizes = [len(self.folder_names(folder)) for folder in folders]
+            if not any(sizes):
+                return None
+
+        # a small pool may only have images that are already on screen. the
+        # avoided images can end one order and start the next, so a folder
+        # takes up to twice as many tries to get past them
+        available = sum(len(self.folder_names(folder)) for folder in folders)
+        for _ in range(min(2 * available, 2 * len(avoid) + 1)):
+            folder = random.choices(folders, weights=sizes)[0]
+            path = self.next_in_folder(folder, skip[folder])
+            if path not in avoid:
+                break
+        return path
+
+    def save(self):
+        """ Write the cursors to disk if any moved"""
+        if not self.dirty:
+            return
+
+        # write to a temp file first so a crash never leaves half a file
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, 'w') as f:
+                json.dump({'version': STATE_VERSION, 'folders': self.folders}, f)
+            os.replace(temp, self.path)
+        except OSError as e:
+            self.logger.log(f"ERROR: could not save the shuffle state: {e}")
+        self.dirty = False
@@ -0,0 +1,120 @@
+"""
+@brief - times the stages of each switch, ie, scanning folders, decoding,
+         resizing, encoding and setting the wallpaper, so switch_time and
+         the cache sizes can be tuned from real numbers.
+
+         Each stage keeps its most recent timings for percentiles, plus a
+         total and count for its whole life. The summary, with the peak
+         memory use, is written to a JSON file every so often, which
+         'main.py --stats' prints while the switcher is running.
+"""
+
+
+import os  # to replace the stats file
+import json  # to read/write the stats file
+import resource  # for peak memory use
+import threading  # stages are timed from background threads too
+from collections import deque  # rolling window of timings
+from contextlib import contextmanager  # for 'with timings.time(...)'
+from time import monotonic, perf_counter  # when to save, and how long stages take
+
+
+# how many recent timings each stage keeps for its percentiles
+WINDOW = 200
+
+# the stats file is written at most this often, in seconds
+SAVE_INTERVAL = 60
+
+
+def percentile(ordered : list[float], p : float) -> float:
+    """ Return the p-th percentile of the sorted timings, in milliseconds"""
+    return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+
+class Timings():
+    """
+            Rolling timings of named stages.
+
+            Class Members:
+                lock : threading.Lock - guards everything below
+                started : float - monotonic time the timings started
+                recent : dict - stage -> deque of its last WINDOW timings, in seconds
+                totals : dict - stage -> [count, total seconds]
+                last_save : float - monotonic time the stats file was last written
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.started = monotonic()
+        self.recent = {}
+        self.totals = {}
+        self.last_save = None
+
+    @contextmanager
+    def time(self, stage : str):
+        """ Time the body of a with block as stage"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - start)
+
+    def record(self, stage : str, seconds : float):
+        """ Add one timing of stage"""
+        with self.lock:
+            if stage not in self.recent:
+                self.recent[stage] = deque(maxlen=WINDOW)
+                self.totals[stage] = [0, 0.0]
+            self.recent[stage].append(seconds)
+            self.totals[stage][0] += 1
+            self.totals[stage][1] += seconds
+
+    def summary(self) -> dict:
+        """ Return the count, mean and total of each stage, the 50th, 90th
+        and 99th percentile and max of its recent timings, in milliseconds,
+        and the peak memory use"""
+        with self.lock:
+            stages = {}
+            for stage, recent in self.recent.items():
+                ordered = sorted(recent)
+                count, total = self.totals[stage]
+                stages[stage] = {'count': count, 'mean_ms': round(total / count * 1000, 2),
+                                 'p50_ms': percentile(ordered, 50), 'p90_ms': percentile(ordered, 90),
+                                 'p99_ms': percentile(ordered, 99),
+                                 'max_ms': round(ordered[-1] * 1000, 2), 'total_s': round(total, 3)}
+
+        # ru_maxrss is in kilobytes on linux
+        return {'uptime_s': round(monotonic() - self.started),
+                'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'stages': stages}
+
+    def save(self, path : str, force : bool = False):
+        """ Write the summary to path, if it has been SAVE_INTERVAL seconds
+        since it was last written or force"""
+        now = monotonic()
+        if not force and self.last_save is not None and now - self.last_save < SAVE_INTERVAL:
+            return
+        self.last_save = now
+
+        # write to a temp file first so --stats never reads half a file
+        temp = path + ".tmp"
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.summary(), f, indent=4)
+            os.replace(temp, path)
+        except OSError:
+            pass # stats are only informational
+
+
+def format_summary(summary : dict) -> str:
+    """ Return a summary from Timings.summary as a table"""
+    lines = [f"up {summary['uptime_s']}s, peak memory {summary['peak_rss_mb']} MB", ""]
+    lines.append(f"{'stage':<16}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}   (ms)")
+    for stage, s in sorted(summary['stages'].items()):
+        lines.append(f"{stage:<16}{s['count']:>8}{s['mean_ms']:>10}{s['p50_ms']:>10}{s['p90_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    return "\n".join(lines)
+
+
+# shared by everything that times a stage
+timings = Timings()
@@ -0,0 +1,301 @@
+"""
+@brief - watches the wallpaper folders for images being added or removed,
+         so they take effect without editing the config file or restarting.
+         Uses inotify on Linux, and falls back to checking folder mtimes
+         on an interval where inotify is not available.
+
+         Also watches the config file itself, so a sleeping switch loop can
+         be woken as soon as the config is saved.
+
+         Changes are queued by the watcher thread and applied to the image
+         lists by the switch loop, so the lists are never modified while
+         the loop is part way through using them.
+"""
+
+
+import os  # to read inotify events and list folders
+import ctypes  # to call inotify from libc
+import ctypes.util  # to find libc
+import struct  # to unpack inotify events
+import select  # to wait on the inotify file descriptor
+import threading  # to watch in the background
+import queue  # to hand changes to the switch loop
+from time import sleep, monotonic  # to pause between polls
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# header of each event, wd, mask, cookie and name length
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def folder_mtime(folder : str) -> int:
+    """ Return the mtime of folder, or None if it can't be read"""
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Inotify():
+    """
+            Minimal wrapper around the Linux inotify calls in libc.
+            Raises OSError when created if inotify is not available.
+
+            Class Members:
+                fd : int - the inotify file descriptor
+                libc : ctypes.CDLL - libc, for inotify_add_watch
+    """
+    def __init__(self):
+
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not available")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path : str, mask : int) -> int:
+        """ Start watching path, returns the watch descriptor"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for '{path}'")
+        return wd
+
+    def read_events(self, timeout : float) -> list[tuple]:
+        """ Wait up to timeout seconds for events. Returns a list of
+        (watch descriptor, mask, file name) tuples, empty on timeout"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher():
+    """
+            Watch a set of folders on a background thread and queue up
+            files that were added to or removed from them. Whether they
+            are images is left to the image index to check. Folders that
+            inotify can't watch, ie, once the user's watch limit is used up,
+            are polled instead.
+
+            Class Members:
+                known : dict - folder -> set of file names
+                changes : queue.Queue - (folder, added, removed) tuples
+                poll_interval : float - seconds between checks when polling
+                stop_event : threading.Event - set to end the thread
+                inotify : Inotify - inotify instance, None when polling
+                watches : dict - inotify watch descriptor -> folder
+                polled : list - folders checked on an interval rather than watched
+                mtimes : dict - polled folder -> its mtime when last listed
+                thread : threading.Thread - the watcher thread
+    """
+    def __init__(self, known : dict, poll_interval : float = 10):
+
+        self.known = {folder: set(names) for folder, names in known.items()}
+        self.changes = queue.Queue()
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+
+        # watches are added before returning, so nothing that happens after
+        # the folders were listed can be missed
+        self.watches = {}
+        self.polled = []
+        try:
+            self.inotify = Inotify()
+            for folder in self.known:
+                try:
+                    wd = self.inotify.add_watch(folder, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM |
+                                                IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+                    self.watches[wd] = folder
+                except OSError:
+                    self.polled.append(folder)
+            target = self._watch
+        except OSError:
+            self.inotify = None
+            self.polled = list(self.known)
+            target = self._poll
+        self.mtimes = {folder: folder_mtime(folder) for folder in self.polled}
+
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ End the watcher thread, ie, when the folders in the config changed"""
+        self.stop_event.set()
+
+    def pending_changes(self) -> list[tuple]:
+        """ Return all (folder, added, removed) changes queued since the
+        last call, where added and removed are lists of full paths"""
+        changes = []
+        while True:
+            try:
+                changes.append(self.changes.get_nowait())
+            except queue.Empty:
+                return changes
+
+    def _report(self, folder : str, added : set, removed : set):
+        """ Update the known files for folder and queue the change. A name
+        in both added and removed was replaced, and is reported as both"""
+        removed = removed & self.known[folder]
+        added = added - (self.known[folder] - removed)
+        if not added and not removed:
+            return
+        self.known[folder] |= added
+        self.known[folder] -= removed
+        self.changes.put((folder,
+                          [os.path.join(folder, name) for name in sorted(added)],
+                          [os.path.join(folder, name) for name in sorted(removed)]))
+
+    def _watch(self):
+        """ Use inotify to wait for changes. only complete writes and moves
+        count as added, so a file is never picked up half written"""
+        last_poll = monotonic()
+        while not self.stop_event.is_set():
+            for wd, mask, name in self.inotify.read_events(1.0):
+                if mask & IN_Q_OVERFLOW:
+                    # the kernel dropped events, so any folder may have changed
+                    for folder in self.watches.values():
+                        self._relist(folder)
+                    continue
+
+                folder = self.watches.get(wd)
+                if folder is None:
+                    continue
+
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    # a file written over in place, or moved over another,
+                    # is removed and added again, so it is checked again
+                    self._report(folder, {name}, {name})
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._report(folder, set(), {name})
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    # the folder itself went away, so everything in it did too
+                    self._report(folder, set(), set(self.known[folder]))
+
+            # folders that couldn't be watched
+            if self.polled and monotonic() - last_poll >= self.poll_interval:
+                last_poll = monotonic()
+                self._check_polled()
+
+        self.inotify.close()
+
+    def _poll(self):
+        """ Fallback without inotify, relist folders whose mtime changed"""
+        while not self.stop_event.wait(self.poll_interval):
+            self._check_polled()
+
+    def _check_polled(self):
+        """ Relist the polled folders whose mtime changed"""
+        for folder in self.polled:
+            mtime = folder_mtime(folder)
+            if mtime == self.mtimes[folder]:
+                continue
+            self.mtimes[folder] = mtime
+            self._relist(folder)
+
+    def _relist(self, folder : str):
+        """ List folder and report how it differs from the known files"""
+        try:
+            names = {f.name for f in os.scandir(folder)}
+        except OSError:
+            names = set()
+        self._report(folder, names - self.known[folder], self.known[folder] - names)
+
+
+class ConfigWatcher():
+    """
+            Watch the config file on a background thread and set an event
+            when it is saved. Watches the folder it is in rather than the
+            file, so editors that save by replacing the file are noticed.
+            Polls the file's ctime where inotify is not available.
+
+            Class Members:
+                path : str - the full path to the config file
+                changed : threading.Event - set when the file changes
+                poll_interval : float - seconds between checks when polling
+                inotify : Inotify - inotify instance, None when polling
+                thread : threading.Thread - the watcher thread
+    """
+    def __init__(self, path : str, poll_interval : float = 1):
+
+        self.path = path
+        self.changed = threading.Event()
+        self.poll_interval = poll_interval
+
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(os.path.dirname(path) or ".", IN_CLOSE_WRITE | IN_MOVED_TO)
+            target = self._watch
+        except OSError:
+            self.inotify = None
+            target = self._poll
+
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout : float) -> bool:
+        """ Wait up to timeout seconds, returns True early if the file changed"""
+        return self.changed.wait(timeout)
+
+    def consume(self) -> bool:
+        """ Return True if the file changed since the last call"""
+        if not self.changed.is_set():
+            return False
+        self.changed.clear()
+        return True
+
+    def _watch(self):
+        name = os.path.basename(self.path)
+        while True:
+            for _, _, event_name in self.inotify.read_events(60.0):
+                if event_name == name:
+                    self.changed.set()
+
+    def _poll(self):
+        """ Fallback without inotify, check the ctime on an interval"""
+        try:
+            last = os.stat(self.path).st_ctime
+        except OSError:
+            last = None
+
+        while True:
+            sleep(self.poll_interval)
+            try:
+                ctime = os.stat(self.path).st_ctime
+            except OSError:
+                ctime = None
+            if ctime != last:
+                last = ctime
+                self.changed.set()